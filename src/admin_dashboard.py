@@ -1,11 +1,65 @@
 """
 Admin dashboard and analytics for Gena bot
 """
-from database import DatabaseManager
-from datetime import datetime, timedelta
+from contextlib import contextmanager
+from dataclasses import dataclass
+from database import DatabaseManager, sqlite3
+from datetime import datetime
 from pathlib import Path
-import json
-import sqlite3
+from typing import Dict, Iterator, Optional
+import functools
+import orjson
+import os
+import threading
+import time
+
+
+# Bytes read per step when scanning the error log backwards
+ERROR_TAIL_CHUNK = 64 * 1024
+
+# Longest a rendered report or aggregate is reused, even without any writes in between
+REPORT_TTL = 30
+
+# Box-drawn report banner; only the timestamp changes between reports
+REPORT_HEADER = """
+╔════════════════════════════════════════╗
+║        GENA BOT - ADMIN REPORT         ║
+║        {timestamp}                 ║
+╚════════════════════════════════════════╝
+"""
+
+
+def _memoized(method):
+    """Reuse an aggregate's result while the database is unchanged, for up to REPORT_TTL seconds"""
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        # Inside a report bundle every dataset must come from the bundle's snapshot,
+        # and its entry point has already flushed, so query directly
+        if getattr(self._held, 'cursor', None) is not None:
+            return method(self, *args)
+        
+        # Pending messages count as a change, so write them out before comparing generations
+        self.db.flush_messages()
+        key = (method.__name__, args)
+        now = time.monotonic()
+        cached = self._memo.get(key)
+        if cached is not None and cached[0] == self.db.generation and now - cached[1] < REPORT_TTL:
+            return cached[2]
+        
+        generation = self.db.generation
+        result = method(self, *args)
+        self._memo[key] = (generation, now, result)
+        return result
+    return wrapper
+
+
+@dataclass(frozen=True, slots=True)
+class ReportBundle:
+    """Every dataset the full admin report needs, read from one snapshot"""
+    stats: dict
+    personas: dict
+    activity: dict
+    top_users: list
 
 
 class AdminDashboard:
@@ -14,242 +68,243 @@ class AdminDashboard:
     def __init__(self, db: DatabaseManager):
         self.db = db
         self.data_dir = Path.cwd() / 'data'
+        # Cursor a report bundle holds across several queries, per thread
+        self._held = threading.local()
+        # (generation, rendered at, text) of the last full report
+        self._report: Optional[tuple] = None
+        # (method, args) -> (generation, computed at, result) for the aggregate reports
+        self._memo: Dict[tuple, tuple] = {}
+        # (mtime, size, limit, errors) of the last error log tail read
+        self._errors_cache: Optional[tuple] = None
     
-    def get_user_stats(self) -> dict:
-        """Get statistics about bot users"""
-        conn = sqlite3.connect(self.db.db_path)
-        cursor = conn.cursor()
-        
-        # Total users
-        cursor.execute('SELECT COUNT(*) FROM users')
-        total_users = cursor.fetchone()[0]
-        
-        # Plan distribution
+    @contextmanager
+    def _cursor(self) -> Iterator[sqlite3.Cursor]:
+        """The bundle's held cursor, or one on a pooled reader; callers flush buffered history first"""
+        held = getattr(self._held, 'cursor', None)
+        if held is not None:
+            yield held
+            return
+        
+        with self.db.read_cursor() as cursor:
+            yield cursor
+    
+    def reset(self):
+        """Forget cached reports, e.g. after the database file was replaced"""
+        self._report = None
+        self._memo.clear()
+    
+    def _plan_distribution(self, cursor: sqlite3.Cursor) -> dict:
+        """Users per plan in effect, so expired plans count as Free"""
         cursor.execute('''
-            SELECT plan, COUNT(*) as count FROM plans
+            SELECT plan, COUNT(*) as count FROM current_plans
             GROUP BY plan
         ''')
-        plan_distribution = dict(cursor.fetchall())
-        
-        # Total messages
-        cursor.execute('SELECT COUNT(*) FROM messages')
-        total_messages = cursor.fetchone()[0]
-        
-        # Average messages per user
-        cursor.execute('''
-            SELECT user_id, COUNT(*) as count FROM messages
-            GROUP BY user_id
-        ''')
-        message_counts = [row[1] for row in cursor.fetchall()]
-        avg_messages = sum(message_counts) / len(message_counts) if message_counts else 0
-        
-        conn.close()
-        
-        return {
-            'total_users': total_users,
-            'plan_distribution': plan_distribution,
-            'total_messages': total_messages,
-            'avg_messages_per_user': round(avg_messages, 2)
-        }
+        return dict(cursor.fetchall())
     
-    def get_popular_personas(self) -> dict:
-        """Get which personas are most popular"""
-        conn = sqlite3.connect(self.db.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT current_persona, COUNT(*) as count FROM settings
-            GROUP BY current_persona
-            ORDER BY count DESC
-        ''')
-        
-        personas = {row[0]: row[1] for row in cursor.fetchall()}
-        conn.close()
-        
-        return personas
+    @_memoized
+    def get_user_stats(self) -> dict:
+        """Get statistics about bot users"""
+        with self._cursor() as cursor:
+            # Totals and the per-user average from the per-user message counts
+            cursor.execute('''
+                SELECT (SELECT COUNT(*) FROM users), COALESCE(SUM(count), 0), COALESCE(AVG(count), 0)
+                FROM user_message_counts
+            ''')
+            total_users, total_messages, avg_messages = cursor.fetchone()
+            plan_distribution = self._plan_distribution(cursor)
+            
+            return {
+                'total_users': total_users,
+                'plan_distribution': plan_distribution,
+                'total_messages': total_messages,
+                'avg_messages_per_user': round(avg_messages, 2)
+            }
     
+    @_memoized
+    def get_popular_personas(self, limit: Optional[int] = None) -> dict:
+        """Get which personas are most popular, most used first"""
+        with self._cursor() as cursor:
+            # LIMIT -1 means no limit in SQLite
+            cursor.execute('''
+                SELECT current_persona, COUNT(*) as count FROM settings
+                GROUP BY current_persona
+                ORDER BY count DESC
+                LIMIT ?
+            ''', (-1 if limit is None else limit,))
+            
+            personas = {row[0]: row[1] for row in cursor.fetchall()}
+            return personas
+    
+    @_memoized
     def get_daily_activity(self, days: int = 7) -> dict:
-        """Get daily message activity for the last N days"""
-        conn = sqlite3.connect(self.db.db_path)
-        cursor = conn.cursor()
-        
-        start_date = (datetime.now() - timedelta(days=days)).date()
-        
-        cursor.execute('''
-            SELECT DATE(created_at) as date, COUNT(*) as count
-            FROM messages
-            WHERE DATE(created_at) >= ?
-            GROUP BY DATE(created_at)
-            ORDER BY date
-        ''', (str(start_date),))
-        
-        activity = {row[0]: row[1] for row in cursor.fetchall()}
-        conn.close()
-        
-        return activity
+        """Get daily message activity for the last N days, oldest day first"""
+        with self._cursor() as cursor:
+            # Days are DATE(created_at), i.e. UTC, so the cutoff is computed in UTC as well
+            cursor.execute('''
+                SELECT day, count FROM daily_message_counts
+                WHERE day >= date('now', ?)
+                ORDER BY day
+            ''', (f'-{days} days',))
+            
+            activity = {row[0]: row[1] for row in cursor.fetchall()}
+            return activity
     
+    @_memoized
     def get_top_users(self, limit: int = 10) -> list:
         """Get most active users"""
-        conn = sqlite3.connect(self.db.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT user_id, COUNT(*) as message_count
-            FROM messages
-            GROUP BY user_id
-            ORDER BY message_count DESC
-            LIMIT ?
-        ''', (limit,))
-        
-        top_users = [
-            {'user_id': row[0], 'messages': row[1]}
-            for row in cursor.fetchall()
-        ]
-        conn.close()
-        
-        return top_users
+        with self._cursor() as cursor:
+            cursor.execute('''
+                SELECT user_id, count AS messages FROM user_message_counts
+                ORDER BY count DESC
+                LIMIT ?
+            ''', (limit,))
+            
+            return [dict(row) for row in cursor]
     
     def get_all_users(self) -> list:
         """Get all users with basic info"""
-        conn = sqlite3.connect(self.db.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT u.user_id, u.username, u.first_name, u.last_name, p.plan
-            FROM users u
-            LEFT JOIN plans p ON u.user_id = p.user_id
-            ORDER BY u.created_at DESC
-        ''')
-        
-        users = []
-        for row in cursor.fetchall():
-            users.append({
-                'user_id': row[0],
-                'username': row[1],
-                'first_name': row[2],
-                'last_name': row[3],
-                'plan': row[4] or 'Free'
-            })
-        
-        conn.close()
-        return users
+        with self._cursor() as cursor:
+            cursor.execute('''
+                SELECT u.user_id, u.username, u.first_name, u.last_name, COALESCE(p.plan, 'Free') AS plan
+                FROM users u
+                LEFT JOIN current_plans p ON u.user_id = p.user_id
+                ORDER BY u.created_at DESC
+            ''')
+            return [dict(row) for row in cursor]
     
     def get_user_details(self, user_id: int) -> dict:
         """Get detailed info about a specific user"""
-        conn = sqlite3.connect(self.db.db_path)
-        cursor = conn.cursor()
-        
-        # Get user info
-        cursor.execute('''
-            SELECT u.user_id, u.username, u.first_name, u.last_name, u.created_at,
-                   p.plan, p.expiration,
-                   s.model, s.current_persona
-            FROM users u
-            LEFT JOIN plans p ON u.user_id = p.user_id
-            LEFT JOIN settings s ON u.user_id = s.user_id
-            WHERE u.user_id = ?
-        ''', (user_id,))
-        
-        result = cursor.fetchone()
-        if not result:
-            conn.close()
-            return None
-        
-        # Get message count
-        cursor.execute('SELECT COUNT(*) FROM messages WHERE user_id = ?', (user_id,))
-        message_count = cursor.fetchone()[0]
-        
-        # Get media count
-        cursor.execute('SELECT COUNT(*) FROM media WHERE user_id = ?', (user_id,))
-        media_count = cursor.fetchone()[0]
-        
-        conn.close()
-        
-        return {
-            'user_id': result[0],
-            'username': result[1],
-            'first_name': result[2],
-            'last_name': result[3],
-            'created_at': result[4],
-            'plan': result[5] or 'Free',
-            'expiration': result[6],
-            'model': result[7],
-            'persona': result[8],
-            'message_count': message_count,
-            'media_count': media_count
-        }
+        # The message count comes from tables the buffered messages have yet to reach
+        self.db.flush_messages()
+        with self._cursor() as cursor:
+            # Get user info
+            cursor.execute('''
+                SELECT u.user_id, u.username, u.first_name, u.last_name, u.created_at,
+                       p.plan, p.expiration, s.model, s.current_persona
+                FROM users u
+                LEFT JOIN current_plans p ON u.user_id = p.user_id
+                LEFT JOIN settings s ON u.user_id = s.user_id
+                WHERE u.user_id = ?
+            ''', (user_id,))
+            
+            result = cursor.fetchone()
+            if not result:
+                return None
+            
+            # Get message count
+            cursor.execute('SELECT count FROM user_message_counts WHERE user_id = ?', (user_id,))
+            row = cursor.fetchone()
+            message_count = row[0] if row else 0
+            
+            # Get media count
+            cursor.execute('SELECT COUNT(*) FROM media WHERE user_id = ?', (user_id,))
+            media_count = cursor.fetchone()[0]
+            
+            return {
+                'user_id': result[0],
+                'username': result[1],
+                'first_name': result[2],
+                'last_name': result[3],
+                'created_at': result[4],
+                'plan': result[5] or 'Free',
+                'expiration': result[6],
+                'model': result[7],
+                'persona': result[8],
+                'message_count': message_count,
+                'media_count': media_count
+            }
     
     def get_user_message_count(self, user_id: int) -> int:
         """Get message count for specific user"""
-        conn = sqlite3.connect(self.db.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT COUNT(*) FROM messages WHERE user_id = ?', (user_id,))
-        count = cursor.fetchone()[0]
-        
-        conn.close()
-        return count
+        self.db.flush_messages()
+        with self._cursor() as cursor:
+            cursor.execute('SELECT count FROM user_message_counts WHERE user_id = ?', (user_id,))
+            row = cursor.fetchone()
+            count = row[0] if row else 0
+            
+            return count
     
+    @_memoized
     def get_plan_distribution(self) -> dict:
         """Get plan distribution"""
-        conn = sqlite3.connect(self.db.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT plan, COUNT(*) as count FROM plans
-            GROUP BY plan
-        ''')
-        
-        distribution = {row[0]: row[1] for row in cursor.fetchall()}
-        conn.close()
-        
-        return distribution
+        with self._cursor() as cursor:
+            return self._plan_distribution(cursor)
     
+    @_memoized
     def get_active_users(self, days: int = 7) -> int:
         """Get count of users active in last N days"""
-        conn = sqlite3.connect(self.db.db_path)
-        cursor = conn.cursor()
-        
-        from datetime import datetime, timedelta
-        cutoff = (datetime.now() - timedelta(days=days)).isoformat()
-        
-        cursor.execute('''
-            SELECT COUNT(DISTINCT user_id) FROM messages
-            WHERE created_at >= ?
-        ''', (cutoff,))
-        
-        count = cursor.fetchone()[0]
-        conn.close()
-        
-        return count
+        with self._cursor() as cursor:
+            # created_at is CURRENT_TIMESTAMP (UTC, space-separated), so compute the cutoff the same way
+            cursor.execute('''
+                SELECT COUNT(DISTINCT user_id) FROM messages
+                WHERE created_at >= datetime('now', ?)
+            ''', (f'-{days} days',))
+            
+            count = cursor.fetchone()[0]
+            return count
 
-    def get_recent_errors(self) -> list:
-        """Get recent errors from error log"""
-        error_file = self.data_dir / 'errors.json'
+    def get_recent_errors(self, limit: int = 50) -> list:
+        """Get recent errors from the tail of the error log"""
+        error_file = self.data_dir / 'errors.jsonl'
         
-        if not error_file.exists():
+        try:
+            st = error_file.stat()
+        except OSError:
             return []
         
+        # The log only changes by appending or rotating, both of which move mtime or size
+        cached = self._errors_cache
+        if cached is not None and cached[:3] == (st.st_mtime_ns, st.st_size, limit):
+            return list(cached[3])
+        
         try:
-            with open(error_file, 'r') as f:
-                errors = json.load(f)
-                return errors[-50:] if isinstance(errors, list) else []
-        except:
+            with open(error_file, 'rb') as f:
+                # Read backwards until the tail holds `limit` complete lines
+                pos = f.seek(0, os.SEEK_END)
+                data = b''
+                while pos > 0 and data.count(b'\n') <= limit:
+                    step = min(ERROR_TAIL_CHUNK, pos)
+                    pos -= step
+                    f.seek(pos)
+                    data = f.read(step) + data
+        except OSError:
             return []
+        
+        errors = []
+        for line in data.splitlines()[-limit:]:
+            try:
+                errors.append(orjson.loads(line))
+            except ValueError:
+                pass
+        self._errors_cache = (st.st_mtime_ns, st.st_size, limit, errors)
+        return list(errors)
+    
+    def _fetch_report_bundle(self, days: int = 7, top: int = 5, personas: Optional[int] = 5) -> ReportBundle:
+        """Run the report aggregates back to back on one reader inside one read transaction"""
+        with self.db.read_cursor(snapshot=True) as cursor:
+            self._held.cursor = cursor
+            try:
+                return ReportBundle(
+                    stats=self.get_user_stats(),
+                    personas=self.get_popular_personas(personas),
+                    activity=self.get_daily_activity(days),
+                    top_users=self.get_top_users(top)
+                )
+            finally:
+                self._held.cursor = None
     
     def generate_report(self) -> str:
         """Generate a full admin report"""
-        stats = self.get_user_stats()
-        personas = self.get_popular_personas()
-        activity = self.get_daily_activity(7)
-        top_users = self.get_top_users(5)
+        self.db.flush_messages()
+        now = time.monotonic()
+        generation = self.db.generation
+        if self._report is not None and self._report[0] == generation and now - self._report[1] < REPORT_TTL:
+            return self._report[2]
         
-        report = f"""
-╔════════════════════════════════════════╗
-║        GENA BOT - ADMIN REPORT         ║
-║        {datetime.now().strftime('%Y-%m-%d %H:%M')}                 ║
-╚════════════════════════════════════════╝
-
+        bundle = self._fetch_report_bundle()
+        stats, personas, activity, top_users = bundle.stats, bundle.personas, bundle.activity, bundle.top_users
+        
+        parts = [REPORT_HEADER.format(timestamp=datetime.now().strftime('%Y-%m-%d %H:%M')), f"""
 📊 USER STATISTICS
 ├── Total Users: {stats['total_users']}
 ├── Plan Distribution:
@@ -261,37 +316,39 @@ class AdminDashboard:
 └── Avg Messages/User: {stats['avg_messages_per_user']}
 
 👤 TOP PERSONAS
-"""
-        for idx, (persona, count) in enumerate(
-            sorted(personas.items(), key=lambda x: x[1], reverse=True)[:5], 
-            1
-        ):
-            report += f"├── {idx}. {persona}: {count} users\n"
+"""]
+        # Both come back already ordered from SQL
+        for idx, (persona, count) in enumerate(personas.items(), 1):
+            parts.append(f"├── {idx}. {persona}: {count} users\n")
         
-        report += "\n📈 7-DAY ACTIVITY\n"
-        for date, count in sorted(activity.items())[-7:]:
+        parts.append("\n📈 7-DAY ACTIVITY\n")
+        for date, count in list(activity.items())[-7:]:
             bar = "█" * min(count // 10, 50)
-            report += f"├── {date}: {bar} ({count} msgs)\n"
+            parts.append(f"├── {date}: {bar} ({count} msgs)\n")
         
-        report += "\n🏆 TOP 5 USERS\n"
+        parts.append("\n🏆 TOP 5 USERS\n")
         for idx, user in enumerate(top_users, 1):
-            report += f"├── {idx}. User {user['user_id']}: {user['messages']} messages\n"
+            parts.append(f"├── {idx}. User {user['user_id']}: {user['messages']} messages\n")
         
+        report = ''.join(parts)
+        self._report = (generation, now, report)
         return report
     
     def export_analytics(self, filepath: str) -> bool:
         """Export analytics to JSON file"""
         try:
+            self.db.flush_messages()
+            bundle = self._fetch_report_bundle(days=30, top=20, personas=None)
             analytics = {
                 'timestamp': datetime.now().isoformat(),
-                'user_stats': self.get_user_stats(),
-                'popular_personas': self.get_popular_personas(),
-                'daily_activity': self.get_daily_activity(30),
-                'top_users': self.get_top_users(20)
+                'user_stats': bundle.stats,
+                'popular_personas': bundle.personas,
+                'daily_activity': bundle.activity,
+                'top_users': bundle.top_users
             }
             
-            with open(filepath, 'w') as f:
-                json.dump(analytics, f, indent=2)
+            with open(filepath, 'wb') as f:
+                f.write(orjson.dumps(analytics, option=orjson.OPT_INDENT_2))
             
             return True
         except Exception as e:
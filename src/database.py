@@ -2,12 +2,161 @@
 Gena - Database Manager
 SQLite database operations for user data, settings, and history
 """
-import sqlite3
-import json
-from datetime import datetime
-from typing import Optional, List, Dict
+# pysqlite3-binary bundles a newer SQLite than most system Pythons; use it when installed
+try:
+    import pysqlite3.dbapi2 as sqlite3
+except ImportError:
+    import sqlite3
+import orjson
+import queue
+import threading
+import time
+import atexit
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Optional, List, Dict, Iterator
 from pathlib import Path
 
+# Per-connection pragmas (journal_mode=WAL is persistent and set once in init_db)
+CONNECTION_PRAGMAS = (
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-20000',
+    'PRAGMA mmap_size=268435456',
+)
+
+# Number of long-lived read-only connections kept open by each DatabaseManager,
+# alongside a single writer connection (SQLite allows one writer at a time anyway)
+POOL_SIZE = 8
+
+# Truncate the WAL after this many message inserts to avoid checkpoint starvation
+WAL_CHECKPOINT_INTERVAL = 1000
+
+# Buffered messages are written once this many are pending, or after the delay
+MESSAGE_BATCH_SIZE = 64
+MESSAGE_FLUSH_DELAY = 0.5
+# While writes keep failing, retries back off up to this delay, and only the
+# newest MESSAGE_BUFFER_LIMIT messages are kept
+MESSAGE_RETRY_MAX_DELAY = 30.0
+MESSAGE_BUFFER_LIMIT = 10000
+
+# Hot queries, kept as constants so the connection's statement cache reuses them
+SQL_GET_PLAN = 'SELECT plan FROM current_plans WHERE user_id = ?'
+SQL_GET_SETTINGS = (
+    'SELECT model, current_persona, system_instruction, custom_instruction '
+    'FROM settings WHERE user_id = ?'
+)
+SQL_GET_USAGE = (
+    'SELECT rate_limit_minute, rate_limit_count, image_limit_count, image_limit_reset, image_limit_prev '
+    'FROM usage WHERE user_id = ?'
+)
+SQL_GET_USER_CONTEXT = (
+    'SELECT p.plan, '
+    's.model, s.current_persona, s.system_instruction, s.custom_instruction, '
+    'u.rate_limit_minute, u.rate_limit_count, u.image_limit_count, u.image_limit_reset, u.image_limit_prev '
+    'FROM current_plans p JOIN settings s USING (user_id) JOIN usage u USING (user_id) '
+    'WHERE p.user_id = ?'
+)
+# The inner query picks the newest rows via the index, the outer one
+# returns them oldest-first so no reversal is needed in Python
+_HISTORY_TEMPLATE = '''
+    SELECT m.id, m.role, m.content, m.created_at, m.media_id, med.file_path, med.mime_type
+    FROM (
+        SELECT id, role, content, created_at, media_id
+        FROM messages
+        WHERE user_id = ?1 {condition}
+        ORDER BY created_at DESC, id DESC
+        LIMIT ?2
+    ) m
+    LEFT JOIN media med ON m.media_id = med.id
+    ORDER BY m.created_at, m.id
+'''
+SQL_GET_HISTORY = _HISTORY_TEMPLATE.format(condition='')
+# Context history skips everything up to the cutoff stored by forget_context
+SQL_GET_CONTEXT_HISTORY = _HISTORY_TEMPLATE.format(
+    condition='AND id > COALESCE((SELECT context_cutoff FROM settings WHERE user_id = ?1), 0)'
+)
+
+# Hot writes
+SQL_INSERT_MESSAGE = 'INSERT INTO messages (user_id, role, content, media_id) VALUES (?, ?, ?, ?)'
+SQL_INSERT_MEDIA = (
+    'INSERT INTO media (user_id, file_id, file_path, mime_type, file_size) VALUES (?, ?, ?, ?, ?)'
+)
+# Fixed text whatever fields are passed, so the statement cache reuses one plan;
+# a NULL parameter leaves that column as it is
+SQL_UPDATE_SETTINGS = '''
+    UPDATE settings SET
+        model = COALESCE(?, model),
+        current_persona = COALESCE(?, current_persona),
+        system_instruction = COALESCE(?, system_instruction),
+        custom_instruction = COALESCE(?, custom_instruction),
+        updated_at = CURRENT_TIMESTAMP
+    WHERE user_id = ?
+'''
+
+# Seconds a cached plan/settings/usage row stays valid
+CACHE_TTL = 60.0
+
+# Upper bound on entries per cache; the least recently used are evicted first
+CACHE_MAX_ENTRIES = 10000
+
+
+class TTLCache:
+    """Small in-memory LRU cache whose entries expire after a fixed TTL"""
+    
+    __slots__ = ('ttl', 'maxsize', '_data', '_lock')
+    
+    def __init__(self, ttl: float = CACHE_TTL, maxsize: int = CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at >= self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def _history_entry(msg_id, role, content, timestamp, media_id, file_path, mime_type) -> Dict:
+    """Shape one history row the way callers expect it"""
+    entry = {
+        'id': msg_id,
+        'role': role,
+        'content': content,
+        'timestamp': timestamp
+    }
+    if media_id and file_path:
+        entry['type'] = 'media'
+        entry['media_ref'] = media_id
+        entry['file_path'] = file_path
+        entry['mime_type'] = mime_type
+    else:
+        entry['type'] = 'text'
+    return entry
+
 
 class DatabaseManager:
     """Manages SQLite database operations"""
@@ -16,179 +165,374 @@ class DatabaseManager:
         self.db_path = db_path
         self.db_dir = Path(db_path).parent
         self.db_dir.mkdir(parents=True, exist_ok=True)
+        self._inserts_since_checkpoint = 0
+        # Bumped after every use of the writer, so readers can tell when data may have changed
+        self.generation = 0
+        self._pool: queue.Queue = queue.Queue(maxsize=POOL_SIZE)
+        self._writer: queue.Queue = queue.Queue(maxsize=1)
+        self._plan_cache = TTLCache()
+        self._settings_cache = TTLCache()
+        self._usage_cache = TTLCache()
+        self._user_info_cache = TTLCache()
+        self._safety_cache: Optional[List[Dict]] = None
+        self._known_profiles = TTLCache()
+        self._message_buffer: List[tuple] = []
+        # Rows taken from the buffer by the flush that is writing them right now
+        self._inflight: List[tuple] = []
+        # Bumped whenever a flush commits, so readers can tell rows moved into the table
+        self._flush_epoch = 0
+        self._flush_failures = 0
+        self._buffer_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_timer: Optional[threading.Timer] = None
+        # Called with (message, exception) for failures no caller sees, e.g. background flushes
+        self.on_error: Optional[Callable[[str, Exception], None]] = None
+        self._fill_pool()
+        self.init_db()
+        atexit.register(self.flush_messages)
+    
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        """Open a connection with the performance pragmas applied"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=512)
+        conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        if read_only:
+            conn.execute('PRAGMA query_only=ON')
+        return conn
+    
+    def _fill_pool(self):
+        self._writer.put(self._connect())
+        for _ in range(POOL_SIZE):
+            self._pool.put(self._connect(read_only=True))
+    
+    @contextmanager
+    def _conn(self, write: bool = False) -> Iterator[sqlite3.Connection]:
+        """Borrow a pooled reader, or the single writer, returning it on exit"""
+        pool = self._writer if write else self._pool
+        conn = pool.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            if write:
+                self.generation += 1
+            pool.put(conn)
+    
+    @contextmanager
+    def read_cursor(self, snapshot: bool = False) -> Iterator[sqlite3.Cursor]:
+        """Cursor on a pooled reader; with snapshot=True all its queries share one read transaction"""
+        with self._conn() as conn:
+            if snapshot:
+                conn.execute('BEGIN')
+            yield conn.cursor()
+    
+    def close(self):
+        """Close every pooled connection"""
+        self.flush_messages()
+        writer = self._writer.get()
+        # Let SQLite refresh any statistics the queries of this run showed to be stale
+        writer.execute('PRAGMA optimize')
+        writer.close()
+        for _ in range(POOL_SIZE):
+            self._pool.get().close()
+    
+    def reconnect(self):
+        """Reopen the pool after close(), e.g. once the database file was replaced"""
+        self._clear_caches()
+        self._fill_pool()
         self.init_db()
     
+    def _clear_caches(self):
+        self._plan_cache.clear()
+        self._settings_cache.clear()
+        self._usage_cache.clear()
+        self._user_info_cache.clear()
+        self._safety_cache = None
+        self._known_profiles.clear()
+    
     def init_db(self):
         """Initialize database with all tables"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Users table with first_name and last_name
+        with self._conn(write=True) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            cursor = conn.cursor()
+            
+            # Users table with first_name and last_name
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    first_name TEXT,
+                    last_name TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Plans table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS plans (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL UNIQUE,
+                    plan TEXT DEFAULT 'Free',
+                    expiration TIMESTAMP,
+                    expiration_ts INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users(user_id)
+                )
+            ''')
+            
+            # Settings table with custom instruction
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS settings (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL UNIQUE,
+                    model TEXT DEFAULT 'gemini-2.5-flash',
+                    current_persona TEXT DEFAULT 'friend',
+                    system_instruction TEXT,
+                    custom_instruction TEXT DEFAULT '',
+                    context_cutoff INTEGER DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users(user_id)
+                )
+            ''')
+            
+            # Add first_name and last_name columns if they don't exist (for existing databases)
+            try:
+                cursor.execute("PRAGMA table_info(users)")
+                columns = [row[1] for row in cursor.fetchall()]
+                if 'first_name' not in columns:
+                    cursor.execute("ALTER TABLE users ADD COLUMN first_name TEXT")
+                    print("✅ Added first_name column to existing database")
+                if 'last_name' not in columns:
+                    cursor.execute("ALTER TABLE users ADD COLUMN last_name TEXT")
+                    print("✅ Added last_name column to existing database")
+            except Exception as e:
+                pass
+            
+            # Last message id hidden from the model by forget_context
+            cursor.execute("PRAGMA table_info(settings)")
+            if 'context_cutoff' not in [row[1] for row in cursor.fetchall()]:
+                cursor.execute("ALTER TABLE settings ADD COLUMN context_cutoff INTEGER DEFAULT 0")
+                print("✅ Added context_cutoff column to settings")
+            
+            # Unix-time copy of the plan expiration so get_user_plan compares integers
+            cursor.execute("PRAGMA table_info(plans)")
+            if 'expiration_ts' not in [row[1] for row in cursor.fetchall()]:
+                cursor.execute("ALTER TABLE plans ADD COLUMN expiration_ts INTEGER")
+                print("✅ Added expiration_ts column to existing database")
+            # Expirations are naive local-time ISO strings, hence the 'utc' modifier
+            cursor.execute('''
+                UPDATE plans SET expiration_ts = CAST(strftime('%s', expiration, 'utc') AS INTEGER)
+                WHERE expiration IS NOT NULL AND expiration_ts IS NULL
+            ''')
+            
+            # The plan in effect: an expired plan counts as Free. Every plan read goes
+            # through this view, so expired rows never need rewriting
+            cursor.execute('''
+                CREATE VIEW IF NOT EXISTS current_plans AS
+                SELECT user_id,
+                    CASE WHEN expiration_ts < CAST(strftime('%s', 'now') AS INTEGER)
+                        THEN 'Free' ELSE plan END AS plan,
+                    CASE WHEN expiration_ts < CAST(strftime('%s', 'now') AS INTEGER)
+                        THEN NULL ELSE expiration END AS expiration
+                FROM plans
+            ''')
+            
+            # Usage table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS usage (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL UNIQUE,
+                    rate_limit_minute INTEGER,
+                    rate_limit_count INTEGER DEFAULT 0,
+                    image_limit_count INTEGER DEFAULT 0,
+                    image_limit_reset INTEGER,
+                    image_limit_prev INTEGER DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users(user_id)
+                )
+            ''')
+            
+            # Previous day's image count, so the sliding window survives a restart
+            cursor.execute("PRAGMA table_info(usage)")
+            if 'image_limit_prev' not in [row[1] for row in cursor.fetchall()]:
+                cursor.execute("ALTER TABLE usage ADD COLUMN image_limit_prev INTEGER DEFAULT 0")
+                print("✅ Added image_limit_prev column to usage")
+            
+            # Separate messages table for each user
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    media_id INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users(user_id),
+                    FOREIGN KEY (media_id) REFERENCES media(id)
+                )
+            ''')
+            
+            # Media reference table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS media (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    file_id TEXT NOT NULL,
+                    file_path TEXT,
+                    mime_type TEXT,
+                    file_size INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users(user_id)
+                )
+            ''')
+            
+            # Safety settings table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS safety_settings (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    settings JSON DEFAULT '[]',
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Create indexes
+            # (user_id, created_at) plus the implicit rowid serves get_history's
+            # "created_at DESC, id DESC" order with a backwards range scan and no sort
+            cursor.execute('DROP INDEX IF EXISTS idx_messages_user')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_created ON messages(user_id, created_at)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_media_user ON media(user_id, created_at DESC)')
+            # Admin reports: popular personas group by persona, and the user list is
+            # ordered newest first. The plan distribution groups current_plans' computed
+            # plan, which no index on plans(plan) can serve
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_settings_persona ON settings(current_persona)')
+            cursor.execute('DROP INDEX IF EXISTS idx_plans_plan')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at DESC)')
+            # Daily activity is served from daily_message_counts now
+            cursor.execute('DROP INDEX IF EXISTS idx_messages_date')
+            
+            self._init_message_counts(cursor)
+            
+            conn.commit()
+            
+            # Fresh planner statistics for the indexes above; the limit keeps this quick on big tables
+            conn.execute('PRAGMA analysis_limit=1000')
+            conn.execute('ANALYZE')
+    
+    def _init_message_counts(self, cursor: sqlite3.Cursor):
+        """Per-day and per-user message counts, kept current by triggers on messages"""
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            CREATE TABLE IF NOT EXISTS daily_message_counts (
+                day TEXT PRIMARY KEY,
+                count INTEGER NOT NULL
             )
         ''')
-        
-        # Plans table
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS plans (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL UNIQUE,
-                plan TEXT DEFAULT 'Free',
-                expiration TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            CREATE TABLE IF NOT EXISTS user_message_counts (
+                user_id INTEGER PRIMARY KEY,
+                count INTEGER NOT NULL
             )
         ''')
         
-        # Settings table with custom instruction
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL UNIQUE,
-                model TEXT DEFAULT 'gemini-2.5-flash',
-                current_persona TEXT DEFAULT 'friend',
-                system_instruction TEXT,
-                custom_instruction TEXT DEFAULT '',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        ''')
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'messages_count_insert'")
+        if cursor.fetchone():
+            return
         
-        # Add first_name and last_name columns if they don't exist (for existing databases)
-        try:
-            cursor.execute("PRAGMA table_info(users)")
-            columns = [row[1] for row in cursor.fetchall()]
-            if 'first_name' not in columns:
-                cursor.execute("ALTER TABLE users ADD COLUMN first_name TEXT")
-                print("✅ Added first_name column to existing database")
-            if 'last_name' not in columns:
-                cursor.execute("ALTER TABLE users ADD COLUMN last_name TEXT")
-                print("✅ Added last_name column to existing database")
-        except Exception as e:
-            pass
-        
-        # Usage table
+        # First run on this database: backfill from existing history, then keep up via triggers
+        cursor.execute('DELETE FROM daily_message_counts')
+        cursor.execute('DELETE FROM user_message_counts')
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS usage (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL UNIQUE,
-                rate_limit_minute TEXT,
-                rate_limit_count INTEGER DEFAULT 0,
-                image_limit_count INTEGER DEFAULT 0,
-                image_limit_reset TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
+            INSERT INTO daily_message_counts (day, count)
+            SELECT DATE(created_at), COUNT(*) FROM messages GROUP BY DATE(created_at)
         ''')
-        
-        # Separate messages table for each user
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                role TEXT NOT NULL,
-                content TEXT NOT NULL,
-                media_id INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id),
-                FOREIGN KEY (media_id) REFERENCES media(id)
-            )
+            INSERT INTO user_message_counts (user_id, count)
+            SELECT user_id, COUNT(*) FROM messages GROUP BY user_id
         ''')
-        
-        # Media reference table
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS media (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                file_id TEXT NOT NULL,
-                file_path TEXT,
-                mime_type TEXT,
-                file_size INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
+            CREATE TRIGGER messages_count_insert AFTER INSERT ON messages
+            BEGIN
+                INSERT INTO daily_message_counts (day, count) VALUES (DATE(NEW.created_at), 1)
+                ON CONFLICT(day) DO UPDATE SET count = count + 1;
+                INSERT INTO user_message_counts (user_id, count) VALUES (NEW.user_id, 1)
+                ON CONFLICT(user_id) DO UPDATE SET count = count + 1;
+            END
         ''')
-        
-        # Safety settings table
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS safety_settings (
-                id INTEGER PRIMARY KEY CHECK (id = 1),
-                settings JSON DEFAULT '[]',
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
+            CREATE TRIGGER messages_count_delete AFTER DELETE ON messages
+            BEGIN
+                UPDATE daily_message_counts SET count = count - 1 WHERE day = DATE(OLD.created_at);
+                DELETE FROM daily_message_counts WHERE day = DATE(OLD.created_at) AND count <= 0;
+                UPDATE user_message_counts SET count = count - 1 WHERE user_id = OLD.user_id;
+                DELETE FROM user_message_counts WHERE user_id = OLD.user_id AND count <= 0;
+            END
         ''')
-        
-        # Create indexes
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_user ON messages(user_id, created_at DESC)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_media_user ON media(user_id, created_at DESC)')
-        
-        conn.commit()
-        conn.close()
+        print("✅ Added message count tables")
     
     def init_user(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None):
         """Initialize a new user"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        # Called on every update: skip the round-trip when this profile was already written
+        profile = (username, first_name, last_name)
+        if self._known_profiles.get(user_id) == profile:
+            return
+        
+        # One transaction for all four rows: a single commit instead of one per statement
+        with self._conn(write=True) as conn, conn:
+            conn.execute('''
+                INSERT INTO users (user_id, username, first_name, last_name) 
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET 
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_name = excluded.last_name,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE (users.username, users.first_name, users.last_name)
+                    IS NOT (excluded.username, excluded.first_name, excluded.last_name)
+            ''', (user_id, username, first_name, last_name))
+            
+            conn.execute('INSERT OR IGNORE INTO plans (user_id) VALUES (?)', (user_id,))
+            conn.execute('INSERT OR IGNORE INTO settings (user_id) VALUES (?)', (user_id,))
+            conn.execute('INSERT OR IGNORE INTO usage (user_id) VALUES (?)', (user_id,))
         
-        cursor.execute('''
-            INSERT INTO users (user_id, username, first_name, last_name) 
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET 
-                username = excluded.username,
-                first_name = excluded.first_name,
-                last_name = excluded.last_name,
-                updated_at = CURRENT_TIMESTAMP
-        ''', (user_id, username, first_name, last_name))
-        
-        cursor.execute('INSERT OR IGNORE INTO plans (user_id) VALUES (?)', (user_id,))
-        cursor.execute('INSERT OR IGNORE INTO settings (user_id) VALUES (?)', (user_id,))
-        cursor.execute('INSERT OR IGNORE INTO usage (user_id) VALUES (?)', (user_id,))
-        
-        conn.commit()
-        conn.close()
+        self._known_profiles.set(user_id, profile)
+        self._user_info_cache.pop(user_id)
     
     def get_user_info(self, user_id: int) -> Dict:
         """Get user information"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cached = self._user_info_cache.get(user_id)
+        if cached is not None:
+            return cached
         
-        cursor.execute('SELECT username, first_name, last_name FROM users WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        conn.close()
+        with self._conn() as conn:
+            result = conn.execute(
+                'SELECT username, first_name, last_name FROM users WHERE user_id = ?', (user_id,)
+            ).fetchone()
         
         if result:
-            return {
+            info = {
                 'username': result[0], 
                 'first_name': result[1],
                 'last_name': result[2],
                 'full_name': f"{result[1]} {result[2]}".strip() if result[1] or result[2] else None
             }
+            self._user_info_cache.set(user_id, info)
+            return info
         return {'username': None, 'first_name': 'friend', 'last_name': None, 'full_name': 'friend'}
     
     def get_user_by_username(self, username: str) -> Optional[Dict]:
         """Find user by username"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Remove @ if present
-        username = username.lstrip('@')
-        
-        cursor.execute('''
-            SELECT user_id, username, first_name, last_name 
-            FROM users 
-            WHERE username IS NOT NULL AND LOWER(username) = LOWER(?)
-        ''', (username,))
-        
-        result = cursor.fetchone()
-        conn.close()
+        with self._conn() as conn:
+            # Remove @ if present
+            username = username.lstrip('@')
+            
+            result = conn.execute('''
+                SELECT user_id, username, first_name, last_name 
+                FROM users 
+                WHERE username IS NOT NULL AND LOWER(username) = LOWER(?)
+            ''', (username,)).fetchone()
         
         if result:
             return {
@@ -201,60 +545,51 @@ class DatabaseManager:
     
     def get_user_plan(self, user_id: int) -> str:
         """Get user's current plan"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cached = self._plan_cache.get(user_id)
+        if cached is not None:
+            return cached
         
-        cursor.execute('SELECT plan, expiration FROM plans WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        conn.close()
+        with self._conn() as conn:
+            result = conn.execute(SQL_GET_PLAN, (user_id,)).fetchone()
         
         if not result:
             return 'Free'
         
-        plan, expiration = result
-        
-        if expiration:
-            exp_time = datetime.fromisoformat(expiration)
-            if exp_time < datetime.now():
-                self.set_user_plan(user_id, 'Free')
-                return 'Free'
-        
-        return plan
+        self._plan_cache.set(user_id, result[0])
+        return result[0]
     
-    def set_user_plan(self, user_id: int, plan: str, expiration: Optional[str] = None):
-        """Set user's plan"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('UPDATE plans SET plan = ?, expiration = ? WHERE user_id = ?', 
-                      (plan, expiration, user_id))
+    def set_user_plan(self, user_id: int, plan: str, expiration_ts: Optional[int] = None):
+        """Set user's plan; expiration is a Unix timestamp"""
+        with self._conn(write=True) as conn:
+            cursor = conn.cursor()
+            
+            # The readable expiration column is derived in SQL, only for display
+            cursor.execute('''
+                UPDATE plans SET plan = ?1, expiration = datetime(?2, 'unixepoch', 'localtime'), expiration_ts = ?2
+                WHERE user_id = ?3
+            ''', (plan, expiration_ts, user_id))
+            
+            conn.commit()
         
-        conn.commit()
-        conn.close()
+        self._plan_cache.pop(user_id)
     
     def get_plan_expiration(self, user_id: int) -> Optional[str]:
-        """Get plan expiration"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT expiration FROM plans WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        conn.close()
+        """Get plan expiration, or None once it has passed"""
+        with self._conn() as conn:
+            result = conn.execute(
+                'SELECT expiration FROM current_plans WHERE user_id = ?', (user_id,)
+            ).fetchone()
         
         return result[0] if result else None
     
     def get_settings(self, user_id: int) -> Dict:
         """Get user settings"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT model, current_persona, system_instruction, custom_instruction 
-            FROM settings WHERE user_id = ?
-        ''', (user_id,))
+        cached = self._settings_cache.get(user_id)
+        if cached is not None:
+            return cached
         
-        result = cursor.fetchone()
-        conn.close()
+        with self._conn() as conn:
+            result = conn.execute(SQL_GET_SETTINGS, (user_id,)).fetchone()
         
         if not result:
             return {
@@ -264,234 +599,324 @@ class DatabaseManager:
                 'customInstruction': ''
             }
         
-        return {
-            'model': result[0],
-            'current_persona': result[1],
-            'systemInstruction': result[2] or '',
-            'customInstruction': result[3] or ''
+        return self._cache_settings(user_id, result)
+    
+    def _cache_settings(self, user_id: int, row: tuple) -> Dict:
+        settings = {
+            'model': row[0],
+            'current_persona': row[1],
+            'systemInstruction': row[2] or '',
+            'customInstruction': row[3] or ''
         }
+        self._settings_cache.set(user_id, settings)
+        return settings
     
     def update_settings(self, user_id: int, **kwargs):
         """Update user settings"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        update_map = {
-            'model': 'model',
-            'current_persona': 'current_persona',
-            'systemInstruction': 'system_instruction',
-            'customInstruction': 'custom_instruction'
-        }
-        
-        updates = []
-        values = []
-        
-        for key, value in kwargs.items():
-            if key in update_map:
-                updates.append(f"{update_map[key]} = ?")
-                values.append(value)
-        
-        if updates:
-            values.append(user_id)
-            query = f'UPDATE settings SET {", ".join(updates)}, updated_at = CURRENT_TIMESTAMP WHERE user_id = ?'
-            cursor.execute(query, values)
-            conn.commit()
-        
-        conn.close()
+        values = (
+            kwargs.get('model'),
+            kwargs.get('current_persona'),
+            kwargs.get('systemInstruction'),
+            kwargs.get('customInstruction'),
+            user_id
+        )
+        if values[:4] != (None, None, None, None):
+            with self._conn(write=True) as conn, conn:
+                conn.execute(SQL_UPDATE_SETTINGS, values)
+        
+        self._settings_cache.pop(user_id)
     
     def add_message(self, user_id: int, role: str, content: str, media_id: int = None):
-        """Add a message to history"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO messages (user_id, role, content, media_id)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, role, content, media_id))
-        
-        conn.commit()
-        conn.close()
+        """Queue a message for the next batched history write"""
+        self.add_messages([(user_id, role, content, media_id)])
+    
+    def add_messages(self, rows: List[tuple]):
+        """Queue several (user_id, role, content, media_id) rows so they land in the same write"""
+        with self._buffer_lock:
+            self._message_buffer.extend(rows)
+            # While writes are failing, the backed-off retry timer drives the next attempt
+            flush_now = len(self._message_buffer) >= MESSAGE_BATCH_SIZE and not self._flush_failures
+            if not flush_now:
+                self._schedule_flush()
+        
+        if flush_now:
+            self.flush_messages()
+    
+    def _schedule_flush(self, delay: float = MESSAGE_FLUSH_DELAY):
+        """Arm the delayed flush unless one is already pending; call with the buffer lock held"""
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(delay, self.flush_messages)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+    
+    def flush_messages(self):
+        """Write all buffered messages in a single transaction"""
+        # One flush at a time. The buffer lock is held only to hand rows over, so
+        # handlers keep queueing messages while the write and checkpoint run
+        with self._flush_lock:
+            with self._buffer_lock:
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+                rows = self._inflight = self._message_buffer
+                self._message_buffer = []
+            
+            if not rows:
+                return
+            
+            with self._conn(write=True) as conn:
+                try:
+                    conn.executemany(SQL_INSERT_MESSAGE, rows)
+                    # Commit and hand-off together, so get_history sees each row
+                    # either pending or stored, never both or neither
+                    with self._buffer_lock:
+                        conn.commit()
+                        self._inflight = []
+                        self._flush_epoch += 1
+                except sqlite3.Error as e:
+                    self._requeue(rows, e)
+                    return
+                
+                self._flush_failures = 0
+                self._inserts_since_checkpoint += len(rows)
+                if self._inserts_since_checkpoint >= WAL_CHECKPOINT_INTERVAL:
+                    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                    self._inserts_since_checkpoint = 0
+    
+    def _requeue(self, rows: List[tuple], error: sqlite3.Error):
+        """Put the rows of a failed write back in front of the buffer and retry with backoff"""
+        self._flush_failures += 1
+        with self._buffer_lock:
+            self._inflight = []
+            buffer = rows + self._message_buffer
+            dropped = len(buffer) - MESSAGE_BUFFER_LIMIT
+            if dropped > 0:
+                buffer = buffer[dropped:]
+            self._message_buffer = buffer
+            self._schedule_flush(min(MESSAGE_FLUSH_DELAY * 2 ** self._flush_failures, MESSAGE_RETRY_MAX_DELAY))
+        
+        self.report_error(f"Failed to write {len(rows)} buffered messages (attempt {self._flush_failures})", error)
+        if dropped > 0:
+            self.report_error(f"Dropped {dropped} buffered messages over the buffer limit", error)
+    
+    def report_error(self, message: str, error: Exception):
+        """Hand a background failure to on_error, or print it when nothing is registered"""
+        if self.on_error is not None:
+            self.on_error(message, error)
+        else:
+            print(f"{message}: {error}")
+    
+    def _drop_pending(self, user_id: int):
+        """Discard a user's buffered messages; call with the flush lock held, so none are mid-write"""
+        with self._buffer_lock:
+            self._message_buffer = [row for row in self._message_buffer if row[0] != user_id]
     
     def add_media(self, user_id: int, file_id: str, file_path: str, mime_type: str, file_size: int) -> int:
         """Add media reference and return media_id"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO media (user_id, file_id, file_path, mime_type, file_size)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, file_id, file_path, mime_type, file_size))
-        
-        media_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        with self._conn(write=True) as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(SQL_INSERT_MEDIA, (user_id, file_id, file_path, mime_type, file_size))
+            
+            media_id = cursor.lastrowid
+            conn.commit()
         
         return media_id
     
-    def get_history(self, user_id: int, limit: int = 100) -> List[Dict]:
-        """Get conversation history"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT m.id, m.role, m.content, m.created_at, m.media_id, med.file_path, med.mime_type
-            FROM messages m
-            LEFT JOIN media med ON m.media_id = med.id
-            WHERE m.user_id = ?
-            ORDER BY m.created_at DESC
-            LIMIT ?
-        ''', (user_id, limit))
-        
-        results = cursor.fetchall()
-        conn.close()
-        
-        history = []
-        for msg_id, role, content, timestamp, media_id, file_path, mime_type in reversed(results):
-            entry = {
-                'id': msg_id,
-                'role': role,
-                'content': content,
-                'timestamp': timestamp
-            }
-            if media_id and file_path:
-                entry['type'] = 'media'
-                entry['media_ref'] = media_id
-                entry['file_path'] = file_path
-                entry['mime_type'] = mime_type
-            else:
-                entry['type'] = 'text'
+    def get_history(self, user_id: int, limit: int = 100, context_only: bool = False) -> List[Dict]:
+        """Get conversation history, including this user's still-buffered messages"""
+        # Buffered rows were queued after any forget_context, which flushes first
+        sql = SQL_GET_CONTEXT_HISTORY if context_only else SQL_GET_HISTORY
+        while True:
+            # Merging the buffer instead of flushing keeps chat turns batched
+            with self._buffer_lock:
+                epoch = self._flush_epoch
+                pending = [row for row in self._inflight + self._message_buffer if row[0] == user_id][-limit:]
+            
+            with self._conn() as conn:
+                stored = conn.execute(sql, (user_id, limit - len(pending))).fetchall()
+                media = {}
+                for media_id in {row[3] for row in pending if row[3]}:
+                    media[media_id] = conn.execute(
+                        'SELECT file_path, mime_type FROM media WHERE id = ?', (media_id,)
+                    ).fetchone()
             
-            history.append(entry)
+            # A flush that committed meanwhile may have moved pending rows into the
+            # table, where the query could also have seen them; read again
+            with self._buffer_lock:
+                if self._flush_epoch == epoch:
+                    break
+        
+        history = [_history_entry(*row) for row in stored]
+        if pending:
+            # Not inserted yet: no id, and the timestamp the insert is about to get
+            now = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+            for _, role, content, media_id in pending:
+                file_path, mime_type = media.get(media_id) or (None, None)
+                history.append(_history_entry(None, role, content, now, media_id, file_path, mime_type))
         
         return history
     
+    def forget_context(self, user_id: int):
+        """Hide every message so far from the model context, keeping the stored history"""
+        # Buffered messages need ids before the cutoff can cover them
+        self.flush_messages()
+        with self._conn(write=True) as conn, conn:
+            conn.execute('''
+                UPDATE settings SET context_cutoff = (
+                    SELECT COALESCE(MAX(id), 0) FROM messages WHERE user_id = ?1
+                )
+                WHERE user_id = ?1
+            ''', (user_id,))
+    
     def clear_history(self, user_id: int):
         """Clear user messages"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('DELETE FROM messages WHERE user_id = ?', (user_id,))
-        
-        conn.commit()
-        conn.close()
+        with self._flush_lock, self._conn(write=True) as conn:
+            self._drop_pending(user_id)
+            cursor = conn.cursor()
+            
+            cursor.execute('DELETE FROM messages WHERE user_id = ?', (user_id,))
+            
+            conn.commit()
     
     def get_usage(self, user_id: int) -> Dict:
         """Get usage stats"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cached = self._usage_cache.get(user_id)
+        if cached is not None:
+            return cached
         
-        cursor.execute('''
-            SELECT rate_limit_minute, rate_limit_count, image_limit_count, image_limit_reset
-            FROM usage WHERE user_id = ?
-        ''', (user_id,))
+        with self._conn() as conn:
+            result = conn.execute(SQL_GET_USAGE, (user_id,)).fetchone()
         
-        result = cursor.fetchone()
-        conn.close()
+        if not result:
+            return {
+                'rateLimit': {'minute': 0, 'count': 0},
+                'imageLimit': {'count': 0, 'resetTime': 0, 'prevCount': 0}
+            }
+        
+        return self._cache_usage(user_id, result)
+    
+    def _cache_usage(self, user_id: int, row: tuple) -> Dict:
+        usage = {
+            'rateLimit': {'minute': row[0], 'count': row[1]},
+            'imageLimit': {'count': row[2], 'resetTime': row[3] or 0, 'prevCount': row[4] or 0}
+        }
+        self._usage_cache.set(user_id, usage)
+        return usage
+    
+    def get_user_context(self, user_id: int) -> Dict:
+        """Plan, settings and usage for a message turn: from the caches, or one joined query that refills them"""
+        plan = self._plan_cache.get(user_id)
+        settings = self._settings_cache.get(user_id)
+        usage = self._usage_cache.get(user_id)
+        if plan is not None and settings is not None and usage is not None:
+            return {'plan': plan, 'settings': settings, 'usage': usage}
+        
+        with self._conn() as conn:
+            result = conn.execute(SQL_GET_USER_CONTEXT, (user_id,)).fetchone()
         
         if not result:
             return {
-                'rateLimit': {'minute': '', 'count': 0},
-                'imageLimit': {'count': 0, 'resetTime': ''}
+                'plan': self.get_user_plan(user_id),
+                'settings': self.get_settings(user_id),
+                'usage': self.get_usage(user_id)
             }
         
+        self._plan_cache.set(user_id, result[0])
         return {
-            'rateLimit': {'minute': result[0], 'count': result[1]},
-            'imageLimit': {'count': result[2], 'resetTime': result[3] or ''}
+            'plan': result[0],
+            'settings': self._cache_settings(user_id, result[1:5]),
+            'usage': self._cache_usage(user_id, result[5:10])
         }
     
-    def update_usage(self, user_id: int, rate_minute: str = None, rate_count: int = None, 
-                    image_count: int = None, image_reset: str = None):
-        """Update usage stats"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        updates = []
-        values = []
-        
-        if rate_minute is not None:
-            updates.append('rate_limit_minute = ?')
-            values.append(rate_minute)
-        if rate_count is not None:
-            updates.append('rate_limit_count = ?')
-            values.append(rate_count)
-        if image_count is not None:
-            updates.append('image_limit_count = ?')
-            values.append(image_count)
-        if image_reset is not None:
-            updates.append('image_limit_reset = ?')
-            values.append(image_reset)
-        
-        if updates:
-            updates.append('updated_at = CURRENT_TIMESTAMP')
-            values.append(user_id)
-            query = f'UPDATE usage SET {", ".join(updates)} WHERE user_id = ?'
-            cursor.execute(query, values)
-            conn.commit()
-        
-        conn.close()
+    def save_image_usage(self, rows: List[tuple]):
+        """Persist (image_count, image_prev, image_reset, user_id) rows in one transaction"""
+        with self._conn(write=True) as conn, conn:
+            conn.executemany('''
+                UPDATE usage SET image_limit_count = ?, image_limit_prev = ?, image_limit_reset = ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE user_id = ?
+            ''', rows)
+        
+        for *_, user_id in rows:
+            self._usage_cache.pop(user_id)
     
-    def get_safety_settings(self) -> List[Dict]:
-        """Get safety settings"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT settings FROM safety_settings WHERE id = 1')
-        result = cursor.fetchone()
-        conn.close()
+    def get_safety_settings(self, path: Optional[str] = None):
+        """Get safety settings, or just the value at a JSON path such as '$[0].threshold'"""
+        if path is not None:
+            # Extract in SQLite instead of parsing the whole document; json_quote
+            # returns scalars and fragments alike as JSON text
+            with self._conn() as conn:
+                result = conn.execute(
+                    'SELECT json_quote(json_extract(settings, ?)) FROM safety_settings WHERE id = 1',
+                    (path,)
+                ).fetchone()
+            return orjson.loads(result[0]) if result else None
+        
+        if self._safety_cache is not None:
+            return self._safety_cache
+        
+        with self._conn() as conn:
+            result = conn.execute('SELECT settings FROM safety_settings WHERE id = 1').fetchone()
         
         if not result or not result[0]:
             return []
         
         try:
-            return json.loads(result[0])
-        except (json.JSONDecodeError, TypeError):
+            self._safety_cache = orjson.loads(result[0])
+        except (orjson.JSONDecodeError, TypeError):
             return []
+        return self._safety_cache
     
-    def set_safety_settings(self, settings: List[Dict]):
-        """Set safety settings"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def set_safety_settings(self, settings: List[Dict], settings_json: Optional[str] = None):
+        """Set safety settings, optionally from an already serialized copy"""
+        if settings_json is None:
+            settings_json = orjson.dumps(settings).decode()
         
-        settings_json = json.dumps(settings)
-        
-        cursor.execute('''
-            INSERT INTO safety_settings (id, settings) VALUES (1, ?)
-            ON CONFLICT(id) DO UPDATE SET settings = excluded.settings, updated_at = CURRENT_TIMESTAMP
-        ''', (settings_json,))
+        with self._conn(write=True) as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                INSERT INTO safety_settings (id, settings) VALUES (1, ?)
+                ON CONFLICT(id) DO UPDATE SET settings = excluded.settings, updated_at = CURRENT_TIMESTAMP
+            ''', (settings_json,))
+            
+            conn.commit()
         
-        conn.commit()
-        conn.close()
+        # The stored value is exactly what we just wrote, so no re-read is needed
+        self._safety_cache = list(settings)
     
     def get_total_users(self) -> int:
         """Get total user count"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM users')
-        count = cursor.fetchone()[0]
-        conn.close()
+        with self._conn() as conn:
+            count = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
         return count
     
     def delete_user_data(self, user_id: int):
         """Delete all data for a specific user"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Delete related records
-        tables = ['messages', 'media', 'plans', 'settings', 'usage']
-        for table in tables:
-            cursor.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+        with self._flush_lock, self._conn(write=True) as conn:
+            self._drop_pending(user_id)
+            cursor = conn.cursor()
             
-        # Delete user record last
-        cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+            # Delete related records
+            tables = ['messages', 'media', 'plans', 'settings', 'usage']
+            for table in tables:
+                cursor.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+                
+            # Delete user record last
+            cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+            
+            conn.commit()
         
-        conn.commit()
-        conn.close()
+        self._plan_cache.pop(user_id)
+        self._settings_cache.pop(user_id)
+        self._usage_cache.pop(user_id)
+        self._user_info_cache.pop(user_id)
+        self._known_profiles.pop(user_id)
     
     def get_total_messages(self) -> int:
         """Get total message count"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM messages')
-        count = cursor.fetchone()[0]
-        conn.close()
+        self.flush_messages()
+        with self._conn() as conn:
+            count = conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
         return count
\ No newline at end of file
@@ -3,7 +3,7 @@ Fix Database - Complete migration and upgrade tool
 Run this to migrate from old versions and fix schema issues
 """
 import sqlite3
-import json
+import orjson
 from pathlib import Path
 from datetime import datetime
 
@@ -158,9 +158,10 @@ def fix_database():
         
         # 5. Create indexes if they don't exist
         print("\n5️⃣  Creating indexes...")
+        cursor.execute('DROP INDEX IF EXISTS idx_messages_user')
         cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_messages_user 
-            ON messages(user_id, created_at DESC)
+            CREATE INDEX IF NOT EXISTS idx_messages_user_created 
+            ON messages(user_id, created_at)
         ''')
         cursor.execute('''
             CREATE INDEX IF NOT EXISTS idx_media_user 
@@ -178,6 +179,9 @@ def fix_database():
             print("   📦 Found old user data - migrating...")
             migrated = 0
             
+            # Scan the directory once and skip existing users with one query, not one per user
+            existing = {row[0] for row in cursor.execute('SELECT user_id FROM users')}
+            pending = []
             for user_dir in users_dir.iterdir():
                 if not user_dir.is_dir():
                     continue
@@ -187,20 +191,22 @@ def fix_database():
                 except ValueError:
                     continue
                 
-                # Check if user already exists
-                cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
-                if cursor.fetchone():
+                if user_id in existing:
                     print(f"   ⏭️  User {user_id} already migrated, skipping...")
                     continue
                 
-                # Insert user
-                cursor.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)', (user_id,))
-                
+                pending.append((user_id, user_dir))
+            
+            # Insert users
+            cursor.executemany('INSERT OR IGNORE INTO users (user_id) VALUES (?)',
+                               [(user_id,) for user_id, _ in pending])
+            
+            for user_id, user_dir in pending:
                 # Migrate plan
                 plan_file = user_dir / 'plan.json'
                 if plan_file.exists():
-                    with open(plan_file, 'r') as f:
-                        plan_data = json.load(f)
+                    with open(plan_file, 'rb') as f:
+                        plan_data = orjson.loads(f.read())
                         cursor.execute('''
                             INSERT OR IGNORE INTO plans (user_id, plan, expiration)
                             VALUES (?, ?, ?)
@@ -209,8 +215,8 @@ def fix_database():
                 # Migrate settings
                 settings_file = user_dir / 'settings.json'
                 if settings_file.exists():
-                    with open(settings_file, 'r') as f:
-                        settings = json.load(f)
+                    with open(settings_file, 'rb') as f:
+                        settings = orjson.loads(f.read())
                         cursor.execute('''
                             INSERT OR IGNORE INTO settings 
                             (user_id, model, current_persona, system_instruction, custom_instruction)
@@ -226,8 +232,8 @@ def fix_database():
                 # Migrate usage
                 usage_file = user_dir / 'usage.json'
                 if usage_file.exists():
-                    with open(usage_file, 'r') as f:
-                        usage = json.load(f)
+                    with open(usage_file, 'rb') as f:
+                        usage = orjson.loads(f.read())
                         rate_limit = usage.get('rateLimit', {})
                         image_limit = usage.get('imageLimit', {})
                         
@@ -247,27 +253,28 @@ def fix_database():
                 # Migrate history - FIXED: Properly insert messages
                 history_file = user_dir / 'history.json'
                 if history_file.exists():
-                    with open(history_file, 'r') as f:
-                        history = json.load(f)
-                        msg_count = 0
+                    with open(history_file, 'rb') as f:
+                        history = orjson.loads(f.read())
+                    
+                    def history_rows():
                         for entry in history:
                             if isinstance(entry, dict) and 'user' in entry and 'bot' in entry:
                                 timestamp = entry.get('timestamp', datetime.now().isoformat())
-                                # User message
-                                cursor.execute('''
-                                    INSERT INTO messages (user_id, role, content, created_at)
-                                    VALUES (?, ?, ?, ?)
-                                ''', (user_id, 'user', entry['user'], timestamp))
-                                # Bot response
-                                cursor.execute('''
-                                    INSERT INTO messages (user_id, role, content, created_at)
-                                    VALUES (?, ?, ?, ?)
-                                ''', (user_id, 'assistant', entry['bot'], timestamp))
-                                msg_count += 1
-                        print(f"      ✅ Migrated {msg_count} message pairs for user {user_id}")
+                                yield (user_id, 'user', entry['user'], timestamp)
+                                yield (user_id, 'assistant', entry['bot'], timestamp)
+                    
+                    # One executemany per user instead of two execute() calls per entry
+                    cursor.executemany('''
+                        INSERT INTO messages (user_id, role, content, created_at)
+                        VALUES (?, ?, ?, ?)
+                    ''', history_rows())
+                    msg_count = cursor.rowcount // 2
+                    print(f"      ✅ Migrated {msg_count} message pairs for user {user_id}")
                 
                 migrated += 1
-                conn.commit()
+            
+            # Single commit for the whole migration
+            conn.commit()
             
             if migrated > 0:
                 print(f"   ✅ Migrated {migrated} users from JSON files")
@@ -283,12 +290,12 @@ def fix_database():
         if safety_file.exists():
             cursor.execute('SELECT id FROM safety_settings WHERE id = 1')
             if not cursor.fetchone():
-                with open(safety_file, 'r') as f:
-                    safety_data = json.load(f)
+                with open(safety_file, 'rb') as f:
+                    safety_data = orjson.loads(f.read())
                     cursor.execute('''
                         INSERT INTO safety_settings (id, settings)
                         VALUES (1, ?)
-                    ''', (json.dumps(safety_data),))
+                    ''', (orjson.dumps(safety_data).decode(),))
                 print("   ✅ Migrated safety settings")
             else:
                 print("   ✅ Safety settings already exist")
@@ -1,13 +1,16 @@
 """
 Gena - AI Telegram Bot Core Logic
 """
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional
-from database import DatabaseManager
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from database import DatabaseManager, TTLCache, sqlite3
 from nlu import NLUEngine
 from personas import get_available_personas, get_persona_instruction, get_persona_name
+import orjson
 import shutil
-import os
+import threading
+import time
 from pathlib import Path
 
 # Plan configuration
@@ -38,6 +41,78 @@ MODEL_DESCRIPTIONS = {
     'gemini-1.5-pro-exp': 'Premium 👑'
 }
 
+
+@dataclass(frozen=True, slots=True)
+class PlanSpec:
+    """Everything a plan allows, resolved once at import"""
+    rate: int
+    turns: int
+    images: int
+    context_turns: int
+    custom_instruction: bool
+    price: int
+    models: Tuple[str, ...]
+    personas: Tuple[str, ...]
+    model_count: int
+    persona_count: int
+
+
+def _build_plan_spec(plan: str) -> PlanSpec:
+    limits = PLAN_LIMITS[plan]
+    models = tuple(ALL_MODELS.get(plan, ALL_MODELS['Free']))
+    personas = get_available_personas(plan)
+    return PlanSpec(
+        rate=limits['rate'],
+        turns=limits['turns'],
+        images=limits['images'],
+        context_turns=limits['context_turns'],
+        custom_instruction=limits['custom_instruction'],
+        price=PLAN_PRICES.get(plan, 0),
+        models=models,
+        personas=personas,
+        model_count=len(models),
+        persona_count=len(personas)
+    )
+
+
+PLAN_SPECS: Dict[str, PlanSpec] = {plan: _build_plan_spec(plan) for plan in PLAN_LIMITS}
+
+_VALID_PLANS = frozenset(PLAN_LIMITS)
+_PAID_PLANS = _VALID_PLANS - {'Free'}
+
+
+def _render_plan_details(spec: PlanSpec) -> str:
+    details = f"💬 Messages: *{spec.rate}/minute*\n"
+    details += f"🖼 Images: *{spec.images}/day*\n"
+    details += f"💭 Context: *{spec.context_turns} turns*\n"
+    details += f"🤖 Models: *{spec.model_count}*\n"
+    details += f"👤 Personas: *{spec.persona_count}*\n"
+    
+    if spec.custom_instruction:
+        details += f"✏️ Custom Instructions: *Yes*\n"
+    
+    if spec.price > 0:
+        details += f"\n⭐ *{spec.price} stars/month*"
+    else:
+        details += f"\n✨ *Free Forever*"
+    
+    return details
+
+
+# Plan details never change at runtime, so render them once
+PLAN_DETAILS: Dict[str, str] = {plan: _render_plan_details(spec) for plan, spec in PLAN_SPECS.items()}
+
+# Changed image counters are persisted once this many users have pending updates,
+# and otherwise at most this many seconds after the first change
+IMAGE_COUNTER_FLUSH_SIZE = 32
+IMAGE_COUNTER_FLUSH_DELAY = 60.0
+
+# Seconds a user's limiter state is kept after its last use. A bucket idle this
+# long has refilled completely, so dropping it changes nothing
+RATE_STATE_TTL = 60.0
+# Image counters are reseeded from the usage table once evicted
+IMAGE_COUNTER_TTL = 3600.0
+
 DEFAULT_SAFETY_SETTINGS = [
     {'category': 'HARM_CATEGORY_HARASSMENT', 'threshold': 'BLOCK_MEDIUM_AND_ABOVE'},
     {'category': 'HARM_CATEGORY_HATE_SPEECH', 'threshold': 'BLOCK_MEDIUM_AND_ABOVE'},
@@ -45,17 +120,97 @@ DEFAULT_SAFETY_SETTINGS = [
     {'category': 'HARM_CATEGORY_DANGEROUS_CONTENT', 'threshold': 'BLOCK_MEDIUM_AND_ABOVE'}
 ]
 
+# Serialized once for the initial seed instead of on every startup
+_DEFAULT_SAFETY_JSON = orjson.dumps(DEFAULT_SAFETY_SETTINGS).decode()
+
+
+def _epoch_day(value) -> int:
+    """Epoch-day index of a stored image reset value; older rows hold a 'YYYY-MM-DD' date"""
+    if isinstance(value, int):
+        return value
+    try:
+        day = datetime.strptime(str(value)[:10], '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    except ValueError:
+        # Unreadable: count it as today rather than handing out a fresh allowance
+        return int(time.time() // 86400)
+    return int(day.timestamp() // 86400)
+
+
+class TokenBucket:
+    """Per-user message allowance refilled continuously up to the plan's per-minute rate"""
+    __slots__ = ('tokens', 'last', 'rate', 'cap')
+    
+    def __init__(self, per_minute: int):
+        self.cap = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.cap
+        self.last = time.monotonic()
+    
+    def allow(self, cost: float = 1.0) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.cap, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True
+        return False
+
+
+class SlidingWindowCounter:
+    """Per-user image allowance: current window plus the previous one weighted by overlap"""
+    __slots__ = ('window', 'curr_index', 'curr_count', 'prev_count')
+    
+    def __init__(self, window: int = 86400, curr_index: int = 0, curr_count: int = 0, prev_count: int = 0):
+        self.window = window
+        self.curr_index = curr_index
+        self.curr_count = curr_count
+        self.prev_count = prev_count
+    
+    def allow(self, limit: int) -> bool:
+        now = time.time()
+        index = int(now // self.window)
+        if index != self.curr_index:
+            self.prev_count = self.curr_count if index == self.curr_index + 1 else 0
+            self.curr_count = 0
+            self.curr_index = index
+        
+        elapsed = (now - index * self.window) / self.window
+        if self.prev_count * (1 - elapsed) + self.curr_count < limit:
+            self.curr_count += 1
+            return True
+        return False
+
 
 class GenaCore:
     """Core business logic"""
     
+    __slots__ = (
+        'db', '_buckets', '_rate_blocked_until', '_image_counters',
+        '_dirty_image_counters', '_image_lock', '_image_flush_timer', '_safety_settings'
+    )
+    
     def __init__(self, db_path: str = 'data/database.db'):
         self.db = DatabaseManager(db_path)
+        # user_id -> in-memory message rate limiter, sized from the user's plan
+        self._buckets = TTLCache(ttl=RATE_STATE_TTL)
+        # user_id -> monotonic time the refused user's bucket holds a token again
+        self._rate_blocked_until = TTLCache(ttl=RATE_STATE_TTL)
+        # user_id -> daily image counter; changed counters are written back in batches
+        # and stay referenced here until then, so eviction never loses a count
+        self._image_counters = TTLCache(ttl=IMAGE_COUNTER_TTL)
+        self._dirty_image_counters: Dict[int, SlidingWindowCounter] = {}
+        # Counters are loaded on worker threads and checked on the event loop
+        self._image_lock = threading.Lock()
+        self._image_flush_timer: Optional[threading.Timer] = None
         self._initialize_safety_settings()
     
     def _initialize_safety_settings(self):
-        if not self.db.get_safety_settings():
-            self.db.set_safety_settings(DEFAULT_SAFETY_SETTINGS)
+        """Load (seeding defaults if needed) and keep the safety settings on the instance"""
+        settings = self.db.get_safety_settings()
+        if not settings:
+            settings = DEFAULT_SAFETY_SETTINGS
+            self.db.set_safety_settings(settings, settings_json=_DEFAULT_SAFETY_JSON)
+        self._safety_settings = settings
     
     def initialize_user(
         self,
@@ -78,19 +233,27 @@ class GenaCore:
     def get_user_plan(self, user_id: int) -> str:
         return self.db.get_user_plan(user_id)
     
+    def get_user_context(self, user_id: int) -> Dict:
+        """Load plan, settings and usage for a message turn in one round-trip"""
+        return self.db.get_user_context(user_id)
+    
     def upgrade_plan(self, user_id: int, plan: str, duration_days: int = 30) -> bool:
-        if plan not in PLAN_LIMITS:
+        if plan not in _VALID_PLANS:
             return False
         
-        expiration = None
-        if plan != 'Free':
-            expiration = (datetime.now() + timedelta(days=duration_days)).isoformat()
+        expiration_ts = None
+        if plan in _PAID_PLANS:
+            expiration_ts = int(time.time()) + duration_days * 86400
         
-        self.db.set_user_plan(user_id, plan, expiration)
+        self.db.set_user_plan(user_id, plan, expiration_ts)
+        self._buckets.pop(user_id)
+        self._rate_blocked_until.pop(user_id)
         return True
     
     def cancel_subscription(self, user_id: int) -> None:
         self.db.set_user_plan(user_id, 'Free', None)
+        self._buckets.pop(user_id)
+        self._rate_blocked_until.pop(user_id)
     
     def get_plan_expiration(self, user_id: int) -> Optional[str]:
         return self.db.get_plan_expiration(user_id)
@@ -101,11 +264,12 @@ class GenaCore:
     def update_settings(self, user_id: int, **kwargs) -> None:
         self.db.update_settings(user_id, **kwargs)
     
-    def get_available_models(self, plan: str) -> List[str]:
-        return ALL_MODELS.get(plan, ALL_MODELS['Free'])
+    def get_available_models(self, plan: str) -> Tuple[str, ...]:
+        return PLAN_SPECS.get(plan, PLAN_SPECS['Free']).models
     
-    def get_available_personas(self, plan: str) -> List[str]:
-        return get_available_personas(plan)
+    def get_available_personas(self, plan: str) -> Tuple[str, ...]:
+        spec = PLAN_SPECS.get(plan)
+        return spec.personas if spec else get_available_personas(plan)
     
     def get_persona_instruction(self, persona_key: str) -> str:
         return get_persona_instruction(persona_key)
@@ -115,7 +279,7 @@ class GenaCore:
     
     def has_custom_instruction(self, user_id: int) -> bool:
         plan = self.get_user_plan(user_id)
-        return PLAN_LIMITS[plan]['custom_instruction']
+        return PLAN_SPECS[plan].custom_instruction
     
     def build_system_instruction(self, user_id: int, persona_key: str) -> str:
         """Build complete system instruction with persona + custom instruction"""
@@ -137,94 +301,163 @@ class GenaCore:
         
         return instruction
     
-    def check_rate_limit(self, user_id: int) -> bool:
-        plan = self.get_user_plan(user_id)
-        usage = self.db.get_usage(user_id)
-        
-        current_minute = datetime.now().strftime('%Y-%m-%d %H:%M')
-        rate_data = usage['rateLimit']
+    def is_rate_blocked(self, user_id: int) -> bool:
+        """Whether a refused user is still waiting for a token; needs no plan or database lookup"""
+        until = self._rate_blocked_until.get(user_id)
+        if until is None:
+            return False
+        if time.monotonic() < until:
+            return True
+        self._rate_blocked_until.pop(user_id)
+        return False
+    
+    def check_rate_limit(self, user_id: int, plan: Optional[str] = None) -> bool:
+        if self.is_rate_blocked(user_id):
+            return False
+        if plan is None:
+            plan = self.get_user_plan(user_id)
+        rate = PLAN_SPECS[plan].rate
         
-        if rate_data['minute'] != current_minute:
-            self.db.update_usage(user_id, rate_minute=current_minute, rate_count=1)
+        bucket = self._buckets.get(user_id)
+        # Rebuild when the plan (and so the rate) changed, e.g. after expiry
+        if bucket is None or bucket.cap != rate:
+            bucket = TokenBucket(rate)
+        # Re-set on every use so only idle buckets expire
+        self._buckets.set(user_id, bucket)
+        if bucket.allow():
             return True
-        else:
-            count = rate_data['count'] + 1
-            self.db.update_usage(user_id, rate_count=count)
-            return count <= PLAN_LIMITS[plan]['rate']
+        self._rate_blocked_until.set(user_id, bucket.last + (1.0 - bucket.tokens) / bucket.rate)
+        return False
     
-    def check_image_limit(self, user_id: int) -> bool:
-        plan = self.get_user_plan(user_id)
-        usage = self.db.get_usage(user_id)
+    def load_image_counter(self, user_id: int) -> SlidingWindowCounter:
+        """The user's daily image counter, seeded from the usage table unless it is already in memory"""
+        with self._image_lock:
+            counter = self._cached_image_counter(user_id)
+        if counter is not None:
+            return counter
         
-        current_day = datetime.now().strftime('%Y-%m-%d')
-        image_data = usage['imageLimit']
+        # Seed from the persisted windows so a restart doesn't reset the allowance
+        image_data = self.db.get_usage(user_id)['imageLimit']
+        seeded = SlidingWindowCounter(
+            curr_index=_epoch_day(image_data['resetTime']),
+            curr_count=image_data['count'] or 0,
+            prev_count=image_data['prevCount'] or 0
+        )
+        with self._image_lock:
+            # Another thread may have loaded it meanwhile; keep the one already counting
+            counter = self._cached_image_counter(user_id) or seeded
+            self._image_counters.set(user_id, counter)
+        return counter
+    
+    def _cached_image_counter(self, user_id: int) -> Optional[SlidingWindowCounter]:
+        """The in-memory counter for a user, if any; call with the image lock held"""
+        counter = self._image_counters.get(user_id) or self._dirty_image_counters.get(user_id)
+        if counter is not None:
+            self._image_counters.set(user_id, counter)
+        return counter
+    
+    def check_image_limit(self, user_id: int, plan: Optional[str] = None) -> bool:
+        """Count one image against the daily allowance; no database work once the counter is loaded"""
+        if plan is None:
+            plan = self.get_user_plan(user_id)
         
-        if image_data['resetTime'] != current_day:
-            self.db.update_usage(user_id, image_count=1, image_reset=current_day)
-            return True
-        else:
-            count = image_data['count'] + 1
-            self.db.update_usage(user_id, image_count=count)
-            return count <= PLAN_LIMITS[plan]['images']
+        counter = self.load_image_counter(user_id)
+        with self._image_lock:
+            if not counter.allow(PLAN_SPECS[plan].images):
+                return False
+            self._dirty_image_counters[user_id] = counter
+            self._schedule_image_flush()
+        return True
+    
+    def _schedule_image_flush(self) -> None:
+        """Arm the background write of changed counters; call with the image lock held"""
+        due = len(self._dirty_image_counters) >= IMAGE_COUNTER_FLUSH_SIZE
+        timer = self._image_flush_timer
+        if timer is not None:
+            if not due or timer.interval == 0:
+                return
+            timer.cancel()
+        
+        self._image_flush_timer = threading.Timer(
+            0 if due else IMAGE_COUNTER_FLUSH_DELAY, self.save_image_counters
+        )
+        self._image_flush_timer.daemon = True
+        self._image_flush_timer.start()
+    
+    def save_image_counters(self) -> None:
+        """Write changed image counters back to the usage table"""
+        with self._image_lock:
+            if self._image_flush_timer is not None:
+                self._image_flush_timer.cancel()
+                self._image_flush_timer = None
+            dirty = self._dirty_image_counters
+            self._dirty_image_counters = {}
+            rows = [
+                (counter.curr_count, counter.prev_count, counter.curr_index, user_id)
+                for user_id, counter in dirty.items()
+            ]
+        
+        if not rows:
+            return
+        try:
+            self.db.save_image_usage(rows)
+        except sqlite3.Error as e:
+            # Keep them for the next attempt; counters changed meanwhile are already back
+            with self._image_lock:
+                for user_id, counter in dirty.items():
+                    self._dirty_image_counters.setdefault(user_id, counter)
+                self._schedule_image_flush()
+            self.db.report_error(f"Failed to save {len(rows)} image counters", e)
     
     def add_message(self, user_id: int, role: str, content: str, media_id: int = None) -> None:
         self.db.add_message(user_id, role, content, media_id)
     
+    def add_turn(self, user_id: int, user_text: str, response_text: str, media_id: int = None) -> None:
+        """Record a user message and the reply together"""
+        self.db.add_messages([
+            (user_id, 'user', user_text, media_id),
+            (user_id, 'assistant', response_text, None)
+        ])
+    
     def add_media(self, user_id: int, file_id: str, file_path: str, mime_type: str, file_size: int) -> int:
         return self.db.add_media(user_id, file_id, file_path, mime_type, file_size)
     
-    def get_context_history(self, user_id: int) -> List[Dict]:
-        plan = self.get_user_plan(user_id)
-        context_turns = PLAN_LIMITS[plan]['context_turns']
+    def get_context_history(self, user_id: int, plan: Optional[str] = None) -> List[Dict]:
+        if plan is None:
+            plan = self.get_user_plan(user_id)
+        context_turns = PLAN_SPECS[plan].context_turns
         
         if context_turns == 0:
             return []
         
-        return self.db.get_history(user_id, limit=context_turns)
+        return self.db.get_history(user_id, limit=context_turns, context_only=True)
     
     def get_full_history(self, user_id: int, limit: int = 100) -> List[Dict]:
         return self.db.get_history(user_id, limit=limit)
     
     def forget_context(self, user_id: int) -> None:
-        pass  # Context is automatically limited by plan
+        """Drop everything so far from the model context while keeping stored history"""
+        self.db.forget_context(user_id)
     
     def detect_intent(self, text: str) -> tuple:
         return NLUEngine.detect_intent(text)
     
     def get_safety_settings(self) -> List[Dict]:
-        return self.db.get_safety_settings()
+        return self._safety_settings
     
     def get_plan_info(self, plan: str) -> Dict:
-        limits = PLAN_LIMITS.get(plan, PLAN_LIMITS['Free'])
-        price = PLAN_PRICES.get(plan, 0)
+        spec = PLAN_SPECS.get(plan, PLAN_SPECS['Free'])
         
         return {
             'plan': plan,
-            'price': price,
-            'limits': limits,
-            'models': self.get_available_models(plan),
+            'price': spec.price,
+            'limits': PLAN_LIMITS.get(plan, PLAN_LIMITS['Free']),
+            'models': spec.models,
             'personas': self.get_available_personas(plan)
         }
     
     def format_plan_details(self, plan: str) -> str:
-        info = self.get_plan_info(plan)
-        limits = info['limits']
-        
-        details = f"💬 Messages: *{limits['rate']}/minute*\n"
-        details += f"🖼 Images: *{limits['images']}/day*\n"
-        details += f"💭 Context: *{limits['context_turns']} turns*\n"
-        details += f"🤖 Models: *{len(info['models'])}*\n"
-        details += f"👤 Personas: *{len(info['personas'])}*\n"
-        
-        if limits['custom_instruction']:
-            details += f"✏️ Custom Instructions: *Yes*\n"
-        
-        if info['price'] > 0:
-            details += f"\n⭐ *{info['price']} stars/month*"
-        else:
-            details += f"\n✨ *Free Forever*"
-        
-        return details
+        return PLAN_DETAILS.get(plan, PLAN_DETAILS['Free'])
 
     def create_backup_zip(self) -> str:
         """Create a zip backup of the data directory"""
@@ -245,6 +478,11 @@ class GenaCore:
     
     def delete_user_data(self, user_id: int):
         self.db.delete_user_data(user_id)
+        self._buckets.pop(user_id)
+        self._rate_blocked_until.pop(user_id)
+        with self._image_lock:
+            self._image_counters.pop(user_id)
+            self._dirty_image_counters.pop(user_id, None)
         
         # Also clean up media files
         media_dir = Path.cwd() / 'data' / 'media' / str(user_id)
@@ -254,14 +492,25 @@ class GenaCore:
             except Exception as e:
                 print(f"Failed to delete media for user {user_id}: {e}")
     
+    def close(self) -> None:
+        """Flush pending writes and close the database"""
+        self.save_image_counters()
+        self.db.close()
+    
     def get_db_path(self) -> str:
         return self.db.db_path
     
     def replace_db(self, file_path: str) -> bool:
         """Replace current database with new file"""
+        # Pooled connections must be closed so the WAL is checkpointed away
+        # before the file underneath them changes
+        self.db.close()
         try:
             shutil.copy2(file_path, self.db.db_path)
             return True
         except Exception as e:
             print(f"DB replacement failed: {e}")
-            return False
\ No newline at end of file
+            return False
+        finally:
+            self.db.reconnect()
+            self._initialize_safety_settings()
\ No newline at end of file
@@ -6,6 +6,10 @@ from enum import Enum
 from typing import Optional, Tuple
 
 
+# Longest text still treated as a possible command phrase
+MAX_COMMAND_LENGTH = 60
+
+
 class Intent(Enum):
     """User intents that can be detected from natural language"""
     CLEAR_HISTORY = "clear_history"
@@ -63,13 +67,20 @@ class NLUEngine:
         Returns:
             Tuple of (Intent, extra_data)
         """
-        text = text.lower().strip()
+        text = text.strip()
+        
+        # Commands are short one-liners; longer or multi-line text is conversation
+        if len(text) > MAX_COMMAND_LENGTH or '\n' in text:
+            return Intent.NONE, None
         
-        for intent, patterns in NLUEngine.INTENT_PATTERNS.items():
-            for pattern in patterns:
-                if re.search(pattern, text):
-                    extra = NLUEngine._extract_extra_info(text, intent)
-                    return intent, extra
+        # Ordinary chat contains none of the words every pattern needs
+        if not _INTENT_KEYWORDS.search(text):
+            return Intent.NONE, None
+        
+        for intent, pattern in _COMPILED_INTENTS:
+            if pattern.search(text):
+                extra = NLUEngine._extract_extra_info(text, intent)
+                return intent, extra
         
         return Intent.NONE, None
     
@@ -78,15 +89,30 @@ class NLUEngine:
         """Extract additional information based on intent"""
         
         if intent == Intent.CHANGE_PERSONA:
-            personas = ['friend', 'advisor', 'artist', 'scholar', 'coach', 'mystic']
-            for persona in personas:
-                if persona in text:
-                    return persona
-        
+            match = _PERSONA_KEYWORDS.search(text)
         elif intent == Intent.CHANGE_MODEL:
-            models = ['flash', 'pro']
-            for model in models:
-                if model in text:
-                    return model
+            match = _MODEL_KEYWORDS.search(text)
+        else:
+            return None
         
-        return None
\ No newline at end of file
+        return match.group().lower() if match else None
+
+
+# One precompiled alternation per intent, checked in declaration order, so each
+# message costs one regex scan per intent instead of one per pattern
+_COMPILED_INTENTS = [
+    (intent, re.compile('|'.join(f'(?:{p})' for p in patterns), re.IGNORECASE))
+    for intent, patterns in NLUEngine.INTENT_PATTERNS.items()
+]
+
+# Every pattern above requires one of these substrings; anything without them
+# cannot match and skips the intent scans entirely
+_INTENT_KEYWORDS = re.compile(
+    'context|history|fresh|conversation|settings|preferences|'
+    'help|commands|what|use|persona|model',
+    re.IGNORECASE
+)
+
+# Extra-info keywords, each set found in one scan of the text
+_PERSONA_KEYWORDS = re.compile('friend|advisor|artist|scholar|coach|mystic', re.IGNORECASE)
+_MODEL_KEYWORDS = re.compile('flash|pro', re.IGNORECASE)
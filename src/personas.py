@@ -2,6 +2,7 @@
 Gena Persona System
 Your friend Gena with different personalities - same friend, different vibes
 """
+import sys
 
 PERSONAS = {
     'buddy': {
@@ -133,27 +134,33 @@ Get up. Do the work. Stop complaining. NOW! 😤"""
     }
 }
 
+# Tuples so the shared per-plan lists can't be mutated by callers
 PERSONA_ACCESS = {
-    'Free': ['buddy', 'sarcastic'],
-    'Basic': ['buddy', 'wise', 'creative', 'sarcastic'],
-    'Premium': ['buddy', 'wise', 'creative', 'geeky', 'hype', 'sarcastic', 'coach'],
-    'VIP': list(PERSONAS.keys())  # All personas
+    'Free': ('buddy', 'sarcastic'),
+    'Basic': ('buddy', 'wise', 'creative', 'sarcastic'),
+    'Premium': ('buddy', 'wise', 'creative', 'geeky', 'hype', 'sarcastic', 'coach'),
+    'VIP': tuple(PERSONAS)  # All personas
 }
 
 
-def get_available_personas(plan: str) -> list:
-    return PERSONA_ACCESS.get(plan, ['buddy'])
+def get_available_personas(plan: str) -> tuple:
+    return PERSONA_ACCESS.get(plan, ('buddy',))
+
+
+# Flat lookup tables built once at import; instructions are interned since they
+# are long and reused verbatim on every request
+_PERSONA_INSTRUCTIONS = {key: sys.intern(p['instruction']) for key, p in PERSONAS.items()}
+_PERSONA_NAMES = {key: p['name'] for key, p in PERSONAS.items()}
+_PERSONA_DESCRIPTIONS = {key: p['description'] for key, p in PERSONAS.items()}
 
 
 def get_persona_instruction(persona_key: str) -> str:
-    if persona_key in PERSONAS:
-        return PERSONAS[persona_key]['instruction']
-    return PERSONAS['buddy']['instruction']
+    return _PERSONA_INSTRUCTIONS.get(persona_key) or _PERSONA_INSTRUCTIONS['buddy']
 
 
 def get_persona_name(persona_key: str) -> str:
-    return PERSONAS.get(persona_key, {}).get('name', '😊 Buddy')
+    return _PERSONA_NAMES.get(persona_key, '😊 Buddy')
 
 
 def get_persona_description(persona_key: str) -> str:
-    return PERSONAS.get(persona_key, {}).get('description', 'Your chill friend')
\ No newline at end of file
+    return _PERSONA_DESCRIPTIONS.get(persona_key, 'Your chill friend')
\ No newline at end of file
@@ -2,104 +2,291 @@
 Gena - Telegram Bot Interface (Fixed for compatibility)
 """
 import os
+import time
+import asyncio
 import base64
-import mimetypes
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict
+from typing import AsyncIterator, List, Dict
 from dotenv import load_dotenv
 import httpx
+import orjson
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, Message, LabeledPrice
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
     PreCheckoutQueryHandler, filters, ContextTypes
 )
-from gena import GenaCore, PLAN_PRICES, MODEL_DESCRIPTIONS
+from telegram.error import BadRequest
+from gena import GenaCore, PLAN_PRICES, PLAN_SPECS, MODEL_DESCRIPTIONS
 from admin_dashboard import AdminDashboard
+from database import POOL_SIZE
+from personas import get_persona_name
 
 load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN', '')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY', '')
-ADMIN_USER_IDS = [int(id.strip()) for id in os.getenv('ADMIN_USER_IDS', '').split(',') if id.strip()]
+ADMIN_USER_IDS = frozenset(int(id.strip()) for id in os.getenv('ADMIN_USER_IDS', '').split(',') if id.strip())
 
 if not all([TELEGRAM_TOKEN, GEMINI_API_KEY]):
     raise ValueError('Missing TELEGRAM_TOKEN or GEMINI_API_KEY')
 
-ALLOWED_MIME_TYPES = ['image/jpeg', 'image/png', 'image/webp', 'image/heic', 'image/heif']
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Telegram's maximum message length, and the minimum gap between streamed edits
+# (Telegram throttles frequent edits of the same message)
+TELEGRAM_MESSAGE_LIMIT = 4096
+STREAM_EDIT_INTERVAL = 1.0
+
+RATE_LIMIT_MESSAGE = "⏱ Rate limit exceeded. Wait a minute! 😊"
+
+# Images above this size are uploaded through the File API rather than inlined
+INLINE_IMAGE_MAX_BYTES = 512 * 1024
+
+# An uploaded file is usable once ACTIVE; poll its state this often, for at most this long
+FILE_POLL_INTERVAL = 0.5
+FILE_ACTIVE_TIMEOUT = 30.0
+
+# The error log is rotated once it grows past this size
+ERROR_LOG_MAX_BYTES = 1024 * 1024
+
+ALLOWED_MIME_TYPES = frozenset({'image/jpeg', 'image/png', 'image/webp', 'image/heic', 'image/heif'})
+
+# Image suffix -> MIME type, for the formats Gemini accepts
+EXTENSION_TO_MIME = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.webp': 'image/webp',
+    '.heic': 'image/heic',
+    '.heif': 'image/heif'
+}
+
+
+# Fixed keyboards are immutable, so one instance is shared by every chat
+BACK_BUTTON = InlineKeyboardButton("🔙 Back", callback_data="settings_back")
+BACK_KEYBOARD = InlineKeyboardMarkup([[BACK_BUTTON]])
+CLEAR_CONFIRM_KEYBOARD = InlineKeyboardMarkup([[
+    InlineKeyboardButton("✅ Yes", callback_data="clear_confirm"),
+    InlineKeyboardButton("❌ No", callback_data="clear_cancel")
+]])
+DELETE_DATA_KEYBOARD = InlineKeyboardMarkup([[
+    InlineKeyboardButton("🔥 DELETE EVERYTHING", callback_data="delete_data_confirm"),
+    InlineKeyboardButton("❌ Cancel", callback_data="delete_data_cancel")
+]])
+CANCEL_CONFIRM_KEYBOARD = InlineKeyboardMarkup([[
+    InlineKeyboardButton("✅ Yes", callback_data="cancel_confirm"),
+    InlineKeyboardButton("❌ No", callback_data="settings_plan")
+]])
+
+
+GENERATION_CONFIG = {
+    'temperature': 0.7,
+    'topK': 40,
+    'topP': 0.95,
+    'maxOutputTokens': 2048
+}
+
+
+@functools.lru_cache(maxsize=256)
+def _encoded_request_tail(system_instruction: str, safety_key: tuple) -> bytes:
+    """JSON for everything after 'contents' in a Gemini request, without the opening brace"""
+    tail = {'generationConfig': GENERATION_CONFIG}
+    
+    if system_instruction:
+        tail['system_instruction'] = {'parts': [{'text': system_instruction}]}
+    
+    if safety_key:
+        tail['safetySettings'] = [{'category': c, 'threshold': t} for c, t in safety_key]
+    
+    return orjson.dumps(tail)[1:]
+
+@functools.lru_cache(maxsize=256)
+def _settings_menu(plan: str, model: str, persona_key: str) -> tuple:
+    """Render the settings menu once per (plan, model, persona)"""
+    text = (
+        f"*⚙️ Settings*\n\n"
+        f"🤖 Model: `{model}`\n"
+        f"👤 Persona: `{get_persona_name(persona_key)}`\n"
+        f"📋 Plan: `{plan}`"
+    )
+    
+    keyboard = [
+        [
+            InlineKeyboardButton("🤖 Model", callback_data="settings_model"),
+            InlineKeyboardButton("👤 Persona", callback_data="settings_persona")
+        ],
+        [InlineKeyboardButton("📋 Your Plan", callback_data="settings_plan")]
+    ]
+    
+    if PLAN_SPECS[plan].custom_instruction:
+        keyboard.insert(1, [InlineKeyboardButton("✏️ Custom Instructions", callback_data="settings_custom")])
+    
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+@functools.lru_cache(maxsize=256)
+def _model_menu(models: tuple, current: str) -> tuple:
+    """Render the model picker once per (available models, current model)"""
+    keyboard = []
+    for model in models:
+        desc = MODEL_DESCRIPTIONS.get(model, 'Standard')
+        check = "✓ " if current == model else ""
+        keyboard.append([InlineKeyboardButton(f"{check}{desc}", callback_data=f"model_{model}")])
+    
+    keyboard.append([BACK_BUTTON])
+    
+    return f"*🤖 Select Model*\n\nCurrent: `{current}`", InlineKeyboardMarkup(keyboard)
+
+
+@functools.lru_cache(maxsize=256)
+def _persona_menu(personas: tuple, current: str) -> tuple:
+    """Render the persona picker once per (available personas, current persona)"""
+    keyboard = []
+    for i in range(0, len(personas), 2):
+        row = []
+        for persona in personas[i:i + 2]:
+            check = "✓ " if persona == current else ""
+            row.append(InlineKeyboardButton(f"{check}{get_persona_name(persona)}", callback_data=f"persona_{persona}"))
+        keyboard.append(row)
+    
+    keyboard.append([BACK_BUTTON])
+    
+    return f"*👤 Select Persona*\n\nCurrent: `{get_persona_name(current)}`", InlineKeyboardMarkup(keyboard)
 
 
 class GeminiAPI:
     """Gemini API client"""
     
+    __slots__ = ('api_key', 'base_url', 'files_url', 'upload_url', 'client')
+    
     def __init__(self, api_key: str):
         self.api_key = api_key
         self.base_url = "https://generativelanguage.googleapis.com/v1beta/models"
+        self.files_url = "https://generativelanguage.googleapis.com/v1beta"
+        self.upload_url = "https://generativelanguage.googleapis.com/upload/v1beta/files"
+        # One long-lived client so TCP/TLS connections are reused across requests
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(30.0, connect=10.0),
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+        )
+    
+    async def aclose(self):
+        """Close pooled HTTP connections"""
+        await self.client.aclose()
     
-    async def generate_content(
+    def _encode_request(
+        self,
+        contents: List[Dict],
+        system_instruction: str = None,
+        safety_settings: List[Dict] = None
+    ) -> bytes:
+        safety_key = tuple(
+            (s['category'], s['threshold']) for s in safety_settings or ()
+            if isinstance(s, dict) and 'category' in s and 'threshold' in s
+        )
+        # Only the conversation changes per request; the rest is spliced in pre-encoded
+        return b'{"contents":' + orjson.dumps(contents) + b',' + _encoded_request_tail(system_instruction or '', safety_key)
+    
+    @staticmethod
+    def _raise_api_error(status_code: int):
+        if status_code == 429:
+            raise Exception("⏱ API rate limit reached. Please try again in a moment.")
+        elif status_code == 400:
+            raise Exception("❌ Invalid request. Please try a different message.")
+        elif status_code == 500:
+            raise Exception("❌ API service error. Please try again later.")
+        else:
+            raise Exception("❌ API error. Please try again.")
+    
+    async def generate_content_stream(
         self, 
         model: str,
         contents: List[Dict],
         system_instruction: str = None,
         safety_settings: List[Dict] = None
-    ) -> Dict:
-        """Generate content from Gemini API"""
-        url = f"{self.base_url}/{model}:generateContent"
+    ) -> AsyncIterator[Dict]:
+        """Stream partial responses from Gemini API as server-sent events"""
+        url = f"{self.base_url}/{model}:streamGenerateContent"
+        params = {'key': self.api_key, 'alt': 'sse'}
+        request_body = self._encode_request(contents, system_instruction, safety_settings)
+        
+        async with self.client.stream('POST', url, params=params, content=request_body, headers=JSON_HEADERS) as response:
+            if response.is_error:
+                self._raise_api_error(response.status_code)
+            
+            async for line in response.aiter_lines():
+                if line.startswith('data: '):
+                    yield orjson.loads(line[6:])
+    
+    async def upload_file(self, data: bytes, mime_type: str) -> str:
+        """Upload raw bytes through the File API and return the file URI once it is ACTIVE"""
         params = {'key': self.api_key}
-        
-        request_body = {
-            'contents': contents,
-            'generationConfig': {
-                'temperature': 0.7,
-                'topK': 40,
-                'topP': 0.95,
-                'maxOutputTokens': 2048
-            }
+        start_headers = {
+            'X-Goog-Upload-Protocol': 'resumable',
+            'X-Goog-Upload-Command': 'start',
+            'X-Goog-Upload-Header-Content-Length': str(len(data)),
+            'X-Goog-Upload-Header-Content-Type': mime_type,
+            **JSON_HEADERS
         }
         
-        if system_instruction:
-            request_body['system_instruction'] = {
-                'parts': [{'text': system_instruction}]
-            }
-        
-        if safety_settings:
-            valid_settings = [
-                s for s in safety_settings 
-                if isinstance(s, dict) and 'category' in s and 'threshold' in s
-            ]
-            if valid_settings:
-                request_body['safetySettings'] = valid_settings
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            try:
-                response = await client.post(url, params=params, json=request_body)
-                response.raise_for_status()
-                return response.json()
-            except httpx.HTTPStatusError as e:
-                if e.response.status_code == 429:
-                    raise Exception("⏱ API rate limit reached. Please try again in a moment.")
-                elif e.response.status_code == 400:
-                    raise Exception("❌ Invalid request. Please try a different message.")
-                elif e.response.status_code == 500:
-                    raise Exception("❌ API service error. Please try again later.")
-                else:
-                    raise Exception("❌ API error. Please try again.")
+        try:
+            start = await self.client.post(self.upload_url, params=params, content=b'{}', headers=start_headers)
+            start.raise_for_status()
+            
+            upload = await self.client.post(
+                start.headers['x-goog-upload-url'],
+                content=data,
+                headers={'X-Goog-Upload-Command': 'upload, finalize', 'X-Goog-Upload-Offset': '0'}
+            )
+            upload.raise_for_status()
+            file = orjson.loads(upload.content)['file']
+            
+            # A file still PROCESSING is rejected by generateContent, so wait for it
+            deadline = time.monotonic() + FILE_ACTIVE_TIMEOUT
+            while file.get('state') != 'ACTIVE':
+                if file.get('state') == 'FAILED' or time.monotonic() >= deadline:
+                    raise Exception("❌ Image upload failed. Please try again.")
+                await asyncio.sleep(FILE_POLL_INTERVAL)
+                status = await self.client.get(f"{self.files_url}/{file['name']}", params=params)
+                status.raise_for_status()
+                file = orjson.loads(status.content)
+            return file['uri']
+        except httpx.HTTPStatusError as e:
+            self._raise_api_error(e.response.status_code)
 
 
 class GenaBot:
     """Main Telegram bot"""
     
+    __slots__ = (
+        'app', 'core', 'gemini', 'dashboard', 'media_dir', 'error_file', '_user_media_dirs', '_db_executor'
+    )
+    
     def __init__(self):
         # Build application with proper configuration
         self.app = (
             Application.builder()
             .token(TELEGRAM_TOKEN)
+            .post_shutdown(self._on_shutdown)
             .build()
         )
         self.core = GenaCore()
         self.gemini = GeminiAPI(GEMINI_API_KEY)
+        self.dashboard = AdminDashboard(self.core.db)
         self.media_dir = Path.cwd() / 'data' / 'media'
         self.media_dir.mkdir(parents=True, exist_ok=True)
+        # data/ exists now, so logging an error needs no mkdir
+        self.error_file = Path.cwd() / 'data' / 'errors.jsonl'
+        # Failed background writes (buffered history, image counters) land in the same log
+        self.core.db.on_error = self._log_background_error
+        # user_id -> media directory already created this run
+        self._user_media_dirs: Dict[int, Path] = {}
+        # One thread per pooled reader plus the writer, separate from the default executor
+        # that file writes and encoding use, so database calls never queue behind those
+        self._db_executor = ThreadPoolExecutor(max_workers=POOL_SIZE + 1, thread_name_prefix='gena-db')
         self._setup_handlers()
     
     def _setup_handlers(self):
@@ -120,13 +307,25 @@ class GenaBot:
         
         self.app.add_error_handler(self.error_handler)
     
+    async def _on_shutdown(self, app: Application):
+        """Close the Gemini client, write out buffered history and close the database on shutdown"""
+        await self.gemini.aclose()
+        self._db_executor.shutdown(wait=True)
+        self.core.close()
+    
+    async def _db(self, fn, *args, **kwargs):
+        """Run a blocking database call on the database executor so other chats keep flowing"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._db_executor, functools.partial(fn, *args, **kwargs)
+        )
+    
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not update.effective_user:
             return
         
         user = update.effective_user
-        self.core.initialize_user(user.id, user.username, user.first_name, user.last_name)
-        plan = self.core.get_user_plan(user.id)
+        await self._db(self.core.initialize_user, user.id, user.username, user.first_name, user.last_name)
+        plan = await self._db(self.core.get_user_plan, user.id)
         
         welcome = (
             f"👋 *Welcome to Gena!*\n\n"
@@ -167,15 +366,10 @@ class GenaBot:
         if not update.effective_user:
             return
         
-        keyboard = [[
-            InlineKeyboardButton("✅ Yes", callback_data="clear_confirm"),
-            InlineKeyboardButton("❌ No", callback_data="clear_cancel")
-        ]]
-        
         await update.message.reply_text(
             "⚠️ *Forget conversation context?*\n\n"
             "(History preserved for reference) 📚",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=CLEAR_CONFIRM_KEYBOARD,
             parse_mode='Markdown'
         )
     
@@ -183,18 +377,13 @@ class GenaBot:
         if not update.effective_user:
             return
         
-        keyboard = [[
-            InlineKeyboardButton("🔥 DELETE EVERYTHING", callback_data="delete_data_confirm"),
-            InlineKeyboardButton("❌ Cancel", callback_data="delete_data_cancel")
-        ]]
-        
         await update.message.reply_text(
             "⚠️ *DANGER ZONE* ⚠️\n\n"
             "Are you sure you want to delete ALL your data?\n"
             "• This cannot be undone.\n"
             "• All messages, media, and settings will be wiped.\n"
             "• You will be reset to a fresh start.",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=DELETE_DATA_KEYBOARD,
             parse_mode='Markdown'
         )
     
@@ -210,18 +399,18 @@ class GenaBot:
         
         args = context.args if context.args else []
         
-        dashboard = AdminDashboard(self.core.db)
+        dashboard = self.dashboard
         
         if not args:
             # Full report
-            report = dashboard.generate_report()
+            report = await self._db(dashboard.generate_report)
             await update.message.reply_text(f"```\n{report}\n```", parse_mode='Markdown')
         
         elif args[0] == 'users':
             # User statistics
             if len(args) > 1 and args[1] == 'list':
                 # List all users with details
-                users = dashboard.get_all_users()
+                users = await self._db(dashboard.get_all_users)
                 text = "*👥 All Users*\n\n"
                 for u in users[:20]:  # First 20
                     name = u['first_name'] or 'Unknown'
@@ -234,7 +423,7 @@ class GenaBot:
                 # Specific user details
                 try:
                     target_id = int(args[1])
-                    user_details = dashboard.get_user_details(target_id)
+                    user_details = await self._db(dashboard.get_user_details, target_id)
                     if user_details:
                         text = f"*👤 User Details*\n\n"
                         text += f"ID: `{user_details['user_id']}`\n"
@@ -255,7 +444,7 @@ class GenaBot:
                     await update.message.reply_text("❌ Invalid user ID")
             else:
                 # User count
-                count = self.core.db.get_total_users()
+                count = await self._db(self.core.db.get_total_users)
                 await update.message.reply_text(f"📊 Total users: *{count}*", parse_mode='Markdown')
         
         elif args[0] == 'messages':
@@ -264,18 +453,18 @@ class GenaBot:
                 # Messages by user
                 try:
                     target_id = int(args[1])
-                    count = dashboard.get_user_message_count(target_id)
+                    count = await self._db(dashboard.get_user_message_count, target_id)
                     await update.message.reply_text(f"💬 User {target_id}: *{count}* messages", parse_mode='Markdown')
                 except ValueError:
                     await update.message.reply_text("❌ Invalid user ID")
             else:
                 # Total messages
-                count = self.core.db.get_total_messages()
+                count = await self._db(self.core.db.get_total_messages)
                 await update.message.reply_text(f"💬 Total messages: *{count}*", parse_mode='Markdown')
         
         elif args[0] == 'plans':
             # Plan distribution
-            distribution = dashboard.get_plan_distribution()
+            distribution = await self._db(dashboard.get_plan_distribution)
             text = "*📊 Plan Distribution*\n\n"
             for plan, count in distribution.items():
                 text += f"{plan}: *{count}* users\n"
@@ -284,7 +473,7 @@ class GenaBot:
         elif args[0] == 'active':
             # Active users (messaged in last N days)
             days = int(args[1]) if len(args) > 1 else 7
-            active = dashboard.get_active_users(days)
+            active = await self._db(dashboard.get_active_users, days)
             await update.message.reply_text(
                 f"🟢 *{active}* users active in last {days} days",
                 parse_mode='Markdown'
@@ -293,7 +482,7 @@ class GenaBot:
         elif args[0] == 'export':
             # Export analytics
             filepath = f"data/analytics_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-            if dashboard.export_analytics(filepath):
+            if await self._db(dashboard.export_analytics, filepath):
                 await update.message.reply_text(f"✅ Exported to `{filepath}`", parse_mode='Markdown')
             else:
                 await update.message.reply_text("❌ Export failed")
@@ -329,7 +518,8 @@ class GenaBot:
             temp_path = f"temp_import_{datetime.now().strftime('%Y%m%d%H%M%S')}.db"
             await file.download_to_drive(temp_path)
             
-            if self.core.replace_db(temp_path):
+            if await self._db(self.core.replace_db, temp_path):
+                dashboard.reset()
                 await update.message.reply_text("✅ Database imported successfully! restarting...")
             else:
                 await update.message.reply_text("❌ detailed import failed.")
@@ -351,7 +541,7 @@ class GenaBot:
             if identifier.isdigit():
                 target_id = int(identifier)
             elif identifier.startswith('@'):
-                user_info = self.core.get_user_by_username(identifier)
+                user_info = await self._db(self.core.get_user_by_username, identifier)
                 if user_info:
                     target_id = user_info['user_id']
                 else:
@@ -359,14 +549,14 @@ class GenaBot:
                     return
             else:
                 # Try as username without @
-                user_info = self.core.get_user_by_username(identifier)
+                user_info = await self._db(self.core.get_user_by_username, identifier)
                 if user_info:
                     target_id = user_info['user_id']
                 else:
                     await update.message.reply_text(f"❌ Invalid identifier. Use ID or @username.")
                     return
             
-            if self.core.upgrade_plan(target_id, plan, days):
+            if await self._db(self.core.upgrade_plan, target_id, plan, days):
                 expiry = f"for {days} days" if days > 0 else "forever"
                 await update.message.reply_text(f"✅ Plan for user {target_id} updated to *{plan}* {expiry}!")
             else:
@@ -391,7 +581,13 @@ class GenaBot:
         
         user = update.effective_user
         user_id = user.id
-        self.core.initialize_user(user_id, user.username, user.first_name, user.last_name)
+        # Users already over their limit are turned away before any database work
+        if self.core.is_rate_blocked(user_id):
+            await update.message.reply_text(RATE_LIMIT_MESSAGE)
+            return
+        
+        await self._db(self.core.initialize_user, user_id, user.username, user.first_name, user.last_name)
+        user_context = await self._db(self.core.get_user_context, user_id)
         
         if update.message.text:
             intent, extra = self.core.detect_intent(update.message.text)
@@ -406,11 +602,14 @@ class GenaBot:
                 await self.help_command(update, context)
                 return
         
-        if not self.core.check_rate_limit(user_id):
-            await update.message.reply_text("⏱ Rate limit exceeded. Wait a minute! 😊")
+        # The rate limiter is in memory, so check it before touching SQLite again
+        if not self.core.check_rate_limit(user_id, user_context['plan']):
+            await update.message.reply_text(RATE_LIMIT_MESSAGE)
             return
         
         try:
+            history = await self._db(self.core.get_context_history, user_id, user_context['plan'])
+            
             parts = []
             text = update.message.text or update.message.caption
             media_id = None
@@ -419,44 +618,50 @@ class GenaBot:
                 parts.append({'text': text})
             
             if update.message.photo:
-                if not self.core.check_image_limit(user_id):
+                # Seeding the counter touches SQLite; the check itself is in memory and
+                # changed counters are written back in the background
+                await self._db(self.core.load_image_counter, user_id)
+                if not self.core.check_image_limit(user_id, user_context['plan']):
                     await update.message.reply_text("🖼 Daily image limit reached! Upgrade for more! 🚀")
                     return
                 
                 photo = update.message.photo[-1]
                 file = await photo.get_file()
                 
-                user_media_dir = self.media_dir / str(user_id)
-                user_media_dir.mkdir(parents=True, exist_ok=True)
+                user_media_dir = self._user_media_dir(user_id)
                 
                 timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
                 file_ext = Path(file.file_path).suffix or '.jpg'
                 file_name = f"{timestamp}_{photo.file_id[:10]}{file_ext}"
                 file_path = user_media_dir / file_name
                 
-                await file.download_to_drive(file_path)
+                # Download once: the same bytes are saved to disk and sent to Gemini.
+                # Saving runs off the loop alongside the encode or upload
+                file_data = bytes(await file.download_as_bytearray())
+                mime_type = EXTENSION_TO_MIME.get(file_ext.lower(), 'image/jpeg')
+                save = asyncio.to_thread(file_path.write_bytes, file_data)
                 
-                mime_type = mimetypes.guess_type(str(file_path))[0] or 'image/jpeg'
-                media_id = self.core.add_media(user_id, photo.file_id, str(file_path), mime_type, photo.file_size)
+                if len(file_data) > INLINE_IMAGE_MAX_BYTES:
+                    # Large images go through the File API instead of a base64 copy in the request
+                    file_uri, _ = await asyncio.gather(self.gemini.upload_file(file_data, mime_type), save)
+                    parts.append({'fileData': {'fileUri': file_uri, 'mimeType': mime_type}})
+                else:
+                    encoded, _ = await asyncio.gather(asyncio.to_thread(base64.b64encode, file_data), save)
+                    parts.append({'inlineData': {'data': encoded.decode(), 'mimeType': mime_type}})
                 
-                file_data = await file.download_as_bytearray()
-                parts.append({
-                    'inlineData': {
-                        'data': base64.b64encode(file_data).decode(),
-                        'mimeType': mime_type
-                    }
-                })
+                media_id = await self._db(
+                    self.core.add_media, user_id, photo.file_id, str(file_path), mime_type, photo.file_size
+                )
             
             if not parts:
                 await update.message.reply_text("Please send text or an image! 📝")
                 return
             
-            settings = self.core.get_settings(user_id)
+            settings = user_context['settings']
             model = settings.get('model', 'gemini-2.5-flash')
             persona = settings.get('current_persona', 'friend')
             
-            system_instruction = self.core.build_system_instruction(user_id, persona)
-            history = self.core.get_context_history(user_id)
+            system_instruction = await self._db(self.core.build_system_instruction, user_id, persona)
             
             contents = []
             for entry in history:
@@ -468,29 +673,47 @@ class GenaBot:
             contents.append({'role': 'user', 'parts': parts})
             
             safety_settings = self.core.get_safety_settings()
-            response = await self.gemini.generate_content(
+            stream = self.gemini.generate_content_stream(
                 model=model,
                 contents=contents,
                 system_instruction=system_instruction,
                 safety_settings=safety_settings
             )
             
-            response_text = self._extract_response_text(response)
+            # Show the reply as it is generated at a throttled pace; once it outgrows
+            # one Telegram message the overflow continues in a new one
+            response_text = ''
+            replies: List[Message] = []
+            shown: List[str] = []
+            last_edit = 0.0
+            async for chunk in stream:
+                response_text += self._extract_response_text(chunk, strip=False)
+                now = time.monotonic()
+                preview = response_text.strip()
+                if preview and now - last_edit >= STREAM_EDIT_INTERVAL:
+                    await self._render_chunks(update.message, replies, shown, self._split_message(preview))
+                    last_edit = now
+            
+            response_text = response_text.strip()
             
             if not response_text:
                 await update.message.reply_text("❌ No response received")
                 return
             
             user_text = text if text else "[Image]"
-            self.core.add_message(user_id, 'user', user_text, media_id)
-            self.core.add_message(user_id, 'assistant', response_text)
-            
-            for chunk in self._split_message(response_text):
-                await update.message.reply_text(
-                    chunk, 
-                    parse_mode='Markdown',
-                    reply_to_message_id=update.message.message_id
-                )
+            await self._db(self.core.add_turn, user_id, user_text, response_text, media_id)
+            
+            # Final render with Markdown; the streamed previews were plain text
+            chunks = self._split_message(response_text)
+            shown = [None] * len(shown)
+            try:
+                await self._render_chunks(update.message, replies, shown, chunks, parse_mode='Markdown')
+            except BadRequest as e:
+                if "parse entities" not in str(e).lower():
+                    raise
+                # Unbalanced markup from the model: the reply is already saved and on
+                # screen, so finish whatever is left as plain text instead
+                await self._render_chunks(update.message, replies, shown, chunks)
         
         except Exception as e:
             await self._log_error(user_id, e)
@@ -510,7 +733,7 @@ class GenaBot:
         data = query.data
         
         if data == "clear_confirm":
-            self.core.forget_context(user_id)
+            await self._db(self.core.forget_context, user_id)
             await query.message.edit_text("✅ Context forgotten! (History preserved) 📚", parse_mode='Markdown')
         
         elif data == "clear_cancel":
@@ -533,29 +756,29 @@ class GenaBot:
         
         elif data.startswith("model_"):
             model = data.split("_", 1)[1]
-            self.core.update_settings(user_id, model=model)
+            await self._db(self.core.update_settings, user_id, model=model)
             
-            keyboard = [[InlineKeyboardButton("🔙 Back", callback_data="settings_back")]]
             await query.message.edit_text(
                 f"✅ Model changed to *{model}*",
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=BACK_KEYBOARD,
                 parse_mode='Markdown'
             )
         
         elif data.startswith("persona_"):
             persona = data.split("_", 1)[1]
-            plan = self.core.get_user_plan(user_id)
+            plan = await self._db(self.core.get_user_plan, user_id)
             available = self.core.get_available_personas(plan)
             
             if persona in available:
                 instruction = self.core.get_persona_instruction(persona)
-                self.core.update_settings(user_id, current_persona=persona, systemInstruction=instruction)
+                await self._db(
+                    self.core.update_settings, user_id, current_persona=persona, systemInstruction=instruction
+                )
                 
                 name = self.core.get_persona_name(persona)
-                keyboard = [[InlineKeyboardButton("🔙 Back", callback_data="settings_back")]]
                 await query.message.edit_text(
                     f"✅ Persona changed to *{name}*",
-                    reply_markup=InlineKeyboardMarkup(keyboard),
+                    reply_markup=BACK_KEYBOARD,
                     parse_mode='Markdown'
                 )
             else:
@@ -571,22 +794,20 @@ class GenaBot:
             await query.answer("⭐ Invoice sent!")
         
         elif data == "cancel_subscription":
-            keyboard = [[
-                InlineKeyboardButton("✅ Yes", callback_data="cancel_confirm"),
-                InlineKeyboardButton("❌ No", callback_data="settings_plan")
-            ]]
             await query.message.edit_text(
                 "⚠️ *Cancel subscription?*\n\nDowngrade to Free plan.",
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=CANCEL_CONFIRM_KEYBOARD,
                 parse_mode='Markdown'
             )
         
         elif data == "cancel_confirm":
-            self.core.cancel_subscription(user_id)
+            await self._db(self.core.cancel_subscription, user_id)
             await query.message.edit_text("✅ Subscription cancelled. Downgraded to Free.")
         
         elif data == "delete_data_confirm":
-            self.core.delete_user_data(user_id)
+            await self._db(self.core.delete_user_data, user_id)
+            # The user's media directory was removed with the rest of their data
+            self._user_media_dirs.pop(user_id, None)
             await query.message.edit_text("👋 Your data has been deleted. Type /start to join again.")
         
         elif data == "delete_data_cancel":
@@ -596,8 +817,7 @@ class GenaBot:
         query = update.pre_checkout_query
         
         try:
-            import json
-            payload = json.loads(query.invoice_payload)
+            payload = orjson.loads(query.invoice_payload)
             plan = payload.get('plan')
             
             if plan not in PLAN_PRICES:
@@ -607,93 +827,53 @@ class GenaBot:
             await query.answer(ok=True)
             
             if query.from_user:
-                self.core.upgrade_plan(query.from_user.id, plan, duration_days=30)
+                await self._db(self.core.upgrade_plan, query.from_user.id, plan, duration_days=30)
         
         except Exception as e:
             await query.answer(ok=False, error_message="Payment error")
     
     async def _show_settings_menu(self, message: Message, user_id: int, edit: bool = False):
-        settings = self.core.get_settings(user_id)
-        plan = self.core.get_user_plan(user_id)
-        persona = self.core.get_persona_name(settings.get('current_persona', 'friend'))
+        settings = await self._db(self.core.get_settings, user_id)
+        plan = await self._db(self.core.get_user_plan, user_id)
         
-        text = (
-            f"*⚙️ Settings*\n\n"
-            f"🤖 Model: `{settings.get('model', 'gemini-2.5-flash')}`\n"
-            f"👤 Persona: `{persona}`\n"
-            f"📋 Plan: `{plan}`"
+        text, markup = _settings_menu(
+            plan,
+            settings.get('model', 'gemini-2.5-flash'),
+            settings.get('current_persona', 'friend')
         )
         
-        keyboard = [
-            [
-                InlineKeyboardButton("🤖 Model", callback_data="settings_model"),
-                InlineKeyboardButton("👤 Persona", callback_data="settings_persona")
-            ],
-            [InlineKeyboardButton("📋 Your Plan", callback_data="settings_plan")]
-        ]
-        
-        if self.core.has_custom_instruction(user_id):
-            keyboard.insert(1, [InlineKeyboardButton("✏️ Custom Instructions", callback_data="settings_custom")])
-        
         if edit:
-            await message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+            await message.edit_text(text, reply_markup=markup, parse_mode='Markdown')
         else:
-            await message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+            await message.reply_text(text, reply_markup=markup, parse_mode='Markdown')
     
     async def _show_model_menu(self, message: Message, user_id: int):
-        plan = self.core.get_user_plan(user_id)
+        plan = await self._db(self.core.get_user_plan, user_id)
         available = self.core.get_available_models(plan)
-        settings = self.core.get_settings(user_id)
+        settings = await self._db(self.core.get_settings, user_id)
         current = settings.get('model', 'gemini-2.5-flash')
         
-        keyboard = []
-        for model in available:
-            desc = MODEL_DESCRIPTIONS.get(model, 'Standard')
-            check = "✓ " if current == model else ""
-            keyboard.append([InlineKeyboardButton(f"{check}{desc}", callback_data=f"model_{model}")])
-        
-        keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="settings_back")])
-        
-        await message.edit_text(
-            f"*🤖 Select Model*\n\nCurrent: `{current}`",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
+        text, markup = _model_menu(available, current)
+        await message.edit_text(text, reply_markup=markup, parse_mode='Markdown')
     
     async def _show_persona_menu(self, message: Message, user_id: int):
-        plan = self.core.get_user_plan(user_id)
+        plan = await self._db(self.core.get_user_plan, user_id)
         available = self.core.get_available_personas(plan)
-        settings = self.core.get_settings(user_id)
+        settings = await self._db(self.core.get_settings, user_id)
         current = settings.get('current_persona', 'friend')
         
-        keyboard = []
-        for i in range(0, len(available), 2):
-            row = []
-            for j in range(2):
-                if i + j < len(available):
-                    persona = available[i + j]
-                    name = self.core.get_persona_name(persona)
-                    check = "✓ " if persona == current else ""
-                    row.append(InlineKeyboardButton(f"{check}{name}", callback_data=f"persona_{persona}"))
-            keyboard.append(row)
-        
-        keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="settings_back")])
-        
-        current_name = self.core.get_persona_name(current)
-        await message.edit_text(
-            f"*👤 Select Persona*\n\nCurrent: `{current_name}`",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
+        text, markup = _persona_menu(available, current)
+        await message.edit_text(text, reply_markup=markup, parse_mode='Markdown')
     
     async def _show_plan_menu(self, message: Message, user_id: int):
-        plan = self.core.get_user_plan(user_id)
-        expiration = self.core.get_plan_expiration(user_id)
+        plan = await self._db(self.core.get_user_plan, user_id)
+        expiration = await self._db(self.core.get_plan_expiration, user_id)
         
         text = f"*📋 Your Plan: {plan}*\n\n{self.core.format_plan_details(plan)}"
         
         if expiration:
-            exp_date = datetime.fromisoformat(expiration).strftime('%Y-%m-%d')
+            # Stored as 'YYYY-MM-DD HH:MM:SS' (or legacy ISO); the date is the prefix
+            exp_date = expiration[:10]
             text += f"\n\n📅 Expires: *{exp_date}*"
         
         keyboard = []
@@ -713,12 +893,12 @@ class GenaBot:
         if plan != 'Free':
             keyboard.append([InlineKeyboardButton("❌ Cancel", callback_data="cancel_subscription")])
         
-        keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="settings_back")])
+        keyboard.append([BACK_BUTTON])
         
         await message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
     
     async def _show_custom_instruction(self, message: Message, user_id: int):
-        settings = self.core.get_settings(user_id)
+        settings = await self._db(self.core.get_settings, user_id)
         custom = settings.get('customInstruction', '').strip()
         
         text = (
@@ -734,11 +914,43 @@ class GenaBot:
         text += "To update, send me your instructions starting with `/custom`\n"
         text += "Example: `/custom Be more formal and technical`"
         
-        keyboard = [[InlineKeyboardButton("🔙 Back", callback_data="settings_back")]]
-        
-        await message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+        await message.edit_text(text, reply_markup=BACK_KEYBOARD, parse_mode='Markdown')
     
-    def _extract_response_text(self, response: Dict) -> str:
+    async def _render_chunks(
+        self,
+        message: Message,
+        replies: List[Message],
+        shown: List[str],
+        chunks: List[str],
+        parse_mode: str = None
+    ):
+        """Edit the replies whose chunk changed and send new replies for the rest"""
+        for index, chunk in enumerate(chunks):
+            if index < len(replies):
+                if shown[index] == chunk:
+                    continue
+                try:
+                    await replies[index].edit_text(chunk, parse_mode=parse_mode)
+                except BadRequest as e:
+                    if 'not modified' not in str(e):
+                        raise
+                shown[index] = chunk
+            else:
+                replies.append(await message.reply_text(
+                    chunk, parse_mode=parse_mode, reply_to_message_id=message.message_id
+                ))
+                shown.append(chunk)
+    
+    def _user_media_dir(self, user_id: int) -> Path:
+        """The user's media directory, created on first use"""
+        user_media_dir = self._user_media_dirs.get(user_id)
+        if user_media_dir is None:
+            user_media_dir = self.media_dir / str(user_id)
+            user_media_dir.mkdir(parents=True, exist_ok=True)
+            self._user_media_dirs[user_id] = user_media_dir
+        return user_media_dir
+    
+    def _extract_response_text(self, response: Dict, strip: bool = True) -> str:
         text = ""
         if 'candidates' in response and response['candidates']:
             candidate = response['candidates'][0]
@@ -746,39 +958,42 @@ class GenaBot:
                 for part in candidate['content']['parts']:
                     if 'text' in part:
                         text += part['text']
-        return text.strip()
+        return text.strip() if strip else text
     
-    def _split_message(self, text: str, max_len: int = 4096) -> List[str]:
+    def _split_message(self, text: str, max_len: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
         if len(text) <= max_len:
             return [text]
         
+        # Walk the text once by index instead of re-slicing the remainder per chunk
         chunks = []
-        while text:
-            if len(text) <= max_len:
-                chunks.append(text)
+        pos, length = 0, len(text)
+        while pos < length:
+            end = pos + max_len
+            if end >= length:
+                chunks.append(text[pos:])
                 break
             
-            split = text.rfind('\n', 0, max_len)
-            if split == -1:
-                split = text.rfind(' ', 0, max_len)
-            if split == -1:
-                split = max_len
+            split = text.rfind('\n', pos, end)
+            if split <= pos:
+                split = text.rfind(' ', pos, end)
+            if split <= pos:
+                split = end
             
-            chunks.append(text[:split])
-            text = text[split:].lstrip()
+            chunks.append(text[pos:split])
+            pos = split
+            while pos < length and text[pos].isspace():
+                pos += 1
         
         return chunks
     
     async def _send_invoice(self, user_id: int, plan: str):
-        import json
-        
         price = PLAN_PRICES.get(plan, 0)
         if price == 0:
             return
         
         title = f"{plan} Plan"
         description = f"1 month subscription to Gena {plan} Plan"
-        payload = json.dumps({'plan': plan, 'duration': 30})
+        payload = orjson.dumps({'plan': plan, 'duration': 30}).decode()
         
         prices = [LabeledPrice(f"{plan} Monthly", price)]
         
@@ -793,12 +1008,9 @@ class GenaBot:
         )
     
     async def _log_error(self, user_id: int, error: Exception):
-        error_dir = Path.cwd() / 'data' 
-        error_dir.mkdir(parents=True, exist_ok=True)
-        
-        import json
         import traceback
         
+        # Captured here: format_exc() only sees the exception on the handling thread
         error_data = {
             'user_id': user_id,
             'error': str(error),
@@ -806,20 +1018,32 @@ class GenaBot:
             'timestamp': datetime.now().isoformat()
         }
         
-        error_file = error_dir / 'errors.json'
-        errors = []
+        await asyncio.to_thread(self._append_error, error_data)
+    
+    def _log_background_error(self, message: str, error: Exception):
+        """Log a failure reported by a database background thread (runs on that thread)"""
+        import traceback
         
-        if error_file.exists():
-            try:
-                with open(error_file, 'r') as f:
-                    errors = json.load(f)
-            except:
-                pass
+        self._append_error({
+            'user_id': None,
+            'error': f"{message}: {error}",
+            'traceback': ''.join(traceback.format_exception(error)),
+            'timestamp': datetime.now().isoformat()
+        })
+    
+    def _append_error(self, error_data: Dict):
+        """Append an error as one JSON line to the error log (runs in a worker thread)"""
+        error_file = self.error_file
         
-        errors.append(error_data)
+        # Keep one previous generation instead of letting the log grow forever
+        try:
+            if error_file.stat().st_size > ERROR_LOG_MAX_BYTES:
+                os.replace(error_file, error_file.with_suffix('.jsonl.1'))
+        except FileNotFoundError:
+            pass
         
-        with open(error_file, 'w') as f:
-            json.dump(errors[-100:], f, indent=2)
+        with open(error_file, 'ab') as f:
+            f.write(orjson.dumps(error_data) + b'\n')
     
     async def error_handler(self, update: object, context: ContextTypes.DEFAULT_TYPE):
         print(f"Error: {context.error}")
@@ -837,5 +1061,12 @@ class GenaBot:
 
 
 if __name__ == '__main__':
+    # uvloop is optional; fall back to the default asyncio loop when it isn't installed
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+    
     bot = GenaBot()
     bot.run()
\ No newline at end of file
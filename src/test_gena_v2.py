@@ -50,7 +50,35 @@ def test_gena_core():
     else:
         print("❌ Backup failed")
         
-    # 6. Test Data Deletion
+    # 6. Test History Order (same-second messages keep insertion order)
+    core.add_message(user_id, 'assistant', 'Hi there')
+    history = core.get_full_history(user_id)
+    assert [m['content'] for m in history] == ['Hello', 'Hi there']
+    print("✅ History order successful")
+    
+    # Forgetting context hides older turns from the model but keeps the stored history
+    core.forget_context(user_id)
+    assert core.get_context_history(user_id) == []
+    core.add_message(user_id, 'user', 'Fresh start')
+    assert [m['content'] for m in core.get_context_history(user_id)] == ['Fresh start']
+    assert len(core.get_full_history(user_id)) == 3
+    print("✅ Forget context successful")
+    
+    # 7. Test Rate and Image Limits (Premium allows its full burst, then refuses)
+    rate = PLAN_LIMITS['Premium']['rate']
+    assert all(core.check_rate_limit(user_id) for _ in range(rate))
+    assert not core.check_rate_limit(user_id)
+    assert core.is_rate_blocked(user_id)
+    print("✅ Rate limit successful")
+    
+    images = PLAN_LIMITS['Premium']['images']
+    assert all(core.check_image_limit(user_id) for _ in range(images))
+    assert not core.check_image_limit(user_id)
+    core.save_image_counters()
+    assert core.db.get_usage(user_id)['imageLimit']['count'] == images
+    print("✅ Image limit successful")
+    
+    # 8. Test Data Deletion
     core.delete_user_data(user_id)
     # Verify deletion
     import sqlite3
@@ -58,11 +86,14 @@ def test_gena_core():
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
     assert cursor.fetchone() is None
+    conn.close()
     print("✅ User data deletion successful")
     
-    # Cleanup
-    if os.path.exists(db_path):
-        os.remove(db_path)
+    # Cleanup (close first so pending writes land and the WAL is checkpointed)
+    core.close()
+    for path in (db_path, db_path + "-wal", db_path + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
     if os.path.exists("data"):
          # cleaning up the test data dir if it was empty, but it might preserve other things
          pass